@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the Booru to Szurubooru uploader
+Runs the real upload pipeline against a local fake Szurubooru server and a synthetic download tree
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import gigglebooruploder as uploader
+
+class FakeSzurubooru(ThreadingHTTPServer):
+    """Local stand-in for the parts of the Szurubooru API the uploader uses"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=0.5):
+        super().__init__(("127.0.0.1", 0), FakeSzurubooruHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.counts = {"uploads": 0, "posts": 0, "errors": 0, "throttled": 0}
+        self.next_id = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+            return self.counts[key]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="fake-szurubooru", daemon=True)
+        thread.start()
+        return thread
+
+class FakeSzurubooruHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle plus
+    # delayed ACKs add ~40ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, extra_headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (extra_headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self, keep=True):
+        """Read the request body, discarding uploaded content in chunks"""
+        remaining = int(self.headers.get("Content-Length") or 0)
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if keep:
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+    def misbehave(self):
+        """Answer with an injected 429 or 5xx, returning True if one was sent"""
+        server = self.server
+        roll = random.random()
+        if roll < server.throttle_rate:
+            server.count("throttled")
+            self.send_json(429, {"name": "TooManyRequests"}, {"Retry-After": str(server.retry_after)})
+            return True
+        if roll < server.throttle_rate + server.error_rate:
+            server.count("errors")
+            self.send_json(503, {"name": "ServiceUnavailable"})
+            return True
+        return False
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.misbehave():
+            return
+        if self.path.startswith("/api/posts/") or self.path.startswith("/api/tags/"):
+            self.send_json(200, {"results": [], "total": 0})
+        else:
+            self.send_json(404, {"name": "NotFound"})
+
+    def do_POST(self):
+        body = self.read_body(keep=self.path != "/api/uploads")
+        time.sleep(self.server.latency)
+        if self.misbehave():
+            return
+        if self.path == "/api/uploads":
+            self.server.count("uploads")
+            self.send_json(200, {"token": os.urandom(8).hex()})
+        elif self.path == "/api/posts":
+            data = json.loads(body)
+            post_id = self.server.count("posts")
+            tags = [{"names": [name], "category": "default"} for name in data.get("tags", [])]
+            self.send_json(200, {"id": post_id, "version": 1, "tags": tags})
+        elif self.path == "/api/tags":
+            data = json.loads(body)
+            self.send_json(200, {"names": data["names"], "category": data.get("category"), "version": 1})
+        else:
+            self.send_json(404, {"name": "NotFound"})
+
+def generate_tree(directory, files, min_size, max_size, max_tags, seed=0):
+    """Create synthetic media files with gallery-dl style sidecars, returning their paths"""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        subdir = Path(directory) / "rule34" / f"page{i // 100}"
+        subdir.mkdir(parents=True, exist_ok=True)
+        path = subdir / f"{i:06d}.jpg"
+        size = rng.randint(min_size, max_size)
+        with open(path, "wb") as f:
+            # Unique prefix so no two files share a checksum
+            f.write(f"{seed}-{i}".encode().ljust(32, b"\0"))
+            remaining = size - 32
+            block = os.urandom(min(remaining, 1024 * 1024)) if remaining > 0 else b""
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        tags = [f"tag_{rng.randint(0, 5000)}" for _ in range(rng.randint(0, max_tags))]
+        metadata = {
+            "category": "rule34",
+            "id": i,
+            "tags": " ".join(tags),
+            "rating": rng.choice("sqe"),
+            "file_url": f"https://example.invalid/{i}.jpg",
+        }
+        with open(str(path) + ".json", "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+        paths.append(path)
+    return paths
+
+FAKE_GALLERY_DL = """#!{python}
+import os, shutil, sys
+args = sys.argv[1:]
+destination = args[args.index("--destination") + 1]
+source = os.environ["BENCHMARK_SOURCE"]
+for root, dirs, files in os.walk(source):
+    for name in sorted(files):
+        if name.endswith(".json"):
+            continue
+        target_dir = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, name)
+        shutil.copyfile(os.path.join(root, name) + ".json", target + ".json")
+        shutil.copyfile(os.path.join(root, name), target)
+        print(target, flush=True)
+"""
+
+def install_fake_gallery_dl(directory):
+    """Put a gallery-dl stand-in on PATH that 'downloads' files from BENCHMARK_SOURCE"""
+    bin_dir = Path(directory) / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "gallery-dl"
+    script.write_text(FAKE_GALLERY_DL.format(python=sys.executable))
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+
+class LatencyRecorder:
+    """Per-file latency from being queued to leaving the upload pipeline"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = {}
+        self.latencies = []
+        self._queue_upload = uploader.queue_upload
+        self._finish_job = uploader.finish_job
+
+    def record(self, filepath):
+        with self.lock:
+            started = self.queued.get(str(filepath))
+            if started is not None:
+                self.latencies.append(time.perf_counter() - started)
+
+    def install(self):
+        def queue_upload(filepath, download_url=None):
+            with self.lock:
+                self.queued.setdefault(str(uploader.state_key(filepath)), time.perf_counter())
+            return self._queue_upload(filepath, download_url)
+
+        def finish_job(job):
+            try:
+                return self._finish_job(job)
+            finally:
+                self.record(job.filepath)
+
+        uploader.queue_upload = queue_upload
+        uploader.finish_job = finish_job
+
+    def uninstall(self):
+        uploader.queue_upload = self._queue_upload
+        uploader.finish_job = self._finish_job
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="giggleupload-bench-")
+    server = FakeSzurubooru(args.latency, args.error_rate, args.throttle_rate, args.retry_after)
+    server.start()
+    recorder = LatencyRecorder()
+    try:
+        # Keep the benchmark away from the user's gallery-dl config and state
+        os.environ["HOME"] = workdir
+        os.environ["APPDATA"] = workdir
+        uploader.SZURU_URL = server.url
+        uploader.STATE_DB = None
+        uploader.UPLOAD_WORKERS = args.workers
+        uploader.ENGINE = args.engine
+        uploader.RETRY_BACKOFF = args.retry_backoff
+
+        source = Path(workdir) / "source"
+        paths = generate_tree(source, args.files, args.min_size, args.max_size, args.max_tags, args.seed)
+        total_bytes = sum(path.stat().st_size for path in paths)
+
+        recorder.install()
+        output = sys.stdout if args.verbose else open(os.devnull, "w")
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            if args.mode == "download":
+                install_fake_gallery_dl(workdir)
+                os.environ["BENCHMARK_SOURCE"] = str(source)
+                uploader.DOWNLOAD_DIR = str(Path(workdir) / "downloads")
+                uploader.download_from_booru("https://rule34.xxx/index.php?page=post&s=list&tags=benchmark")
+            else:
+                uploader.DOWNLOAD_DIR = str(source)
+                workers, monitor_thread = uploader.start_pipeline()
+                for path in paths:
+                    uploader.queue_upload(path)
+                uploader.wait_for_uploads()
+                uploader.stop_pipeline(workers, monitor_thread)
+        elapsed = time.perf_counter() - started
+        if output is not sys.stdout:
+            output.close()
+    finally:
+        recorder.uninstall()
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    stats = uploader.upload_stats.snapshot()
+    return {
+        "mode": args.mode,
+        "files": args.files,
+        "engine": args.engine,
+        "workers": args.workers,
+        "uploaded": stats["uploaded"],
+        "failed": stats["failed"],
+        "retries": stats["retries"],
+        "seconds": round(elapsed, 3),
+        "files_per_sec": round(args.files / elapsed, 2),
+        "bytes_per_sec": round(total_bytes / elapsed),
+        "p50_latency_ms": round(percentile(recorder.latencies, 0.50) * 1000, 1),
+        "p99_latency_ms": round(percentile(recorder.latencies, 0.99) * 1000, 1),
+        "peak_rss_mb": round(peak_rss_bytes() / (1024 * 1024), 1),
+        "server": dict(server.counts),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the uploader against a local fake Szurubooru")
+    parser.add_argument("--mode", choices=("upload", "download"), default="upload",
+                        help="queue a ready-made tree (upload) or run download_from_booru with a fake gallery-dl")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--min-size", type=int, default=50 * 1024, help="smallest file in bytes")
+    parser.add_argument("--max-size", type=int, default=2 * 1024 * 1024, help="largest file in bytes")
+    parser.add_argument("--max-tags", type=int, default=60, help="most tags in one sidecar")
+    parser.add_argument("--workers", type=int, default=uploader.UPLOAD_WORKERS)
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default=uploader.ENGINE)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the fake server takes per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After sent with 429s")
+    parser.add_argument("--retry-backoff", type=float, default=0.1, help="uploader RETRY_BACKOFF during the run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print one JSON line instead of a table")
+    parser.add_argument("--verbose", action="store_true", help="show the uploader's own output")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run_benchmark(args)
+    if args.json:
+        print(json.dumps(result))
+        return 0
+
+    print("Uploader benchmark")
+    print("=" * 50)
+    print(f"  Mode:         {result['mode']} ({result['workers']} workers)")
+    print(f"  Files:        {result['uploaded']} uploaded, {result['failed']} failed, {result['retries']} retries")
+    print(f"  Wall time:    {result['seconds']} s")
+    print(f"  Throughput:   {result['files_per_sec']} files/s, {result['bytes_per_sec'] / (1024 * 1024):.1f} MiB/s")
+    print(f"  Latency:      p50 {result['p50_latency_ms']} ms, p99 {result['p99_latency_ms']} ms")
+    print(f"  Peak RSS:     {result['peak_rss_mb']} MiB")
+    print(f"  Server:       {result['server']}")
+    print("=" * 50)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
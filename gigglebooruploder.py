@@ -4,14 +4,60 @@ Booru to Szurubooru Uploader (Real-time upload version)
 Downloads images from booru sites using gallery-dl and uploads them to Szurubooru instantly
 """
 
+import argparse
+import hashlib
+import heapq
+import importlib.util
+import io
+import itertools
 import json
 import os
+import random
+import select
+import shutil
+import signal
+import sqlite3
+import struct
 import subprocess
-import requests
+import sys
+import tempfile
 from pathlib import Path
 import time
-from threading import Thread, Event
-from queue import Queue
+import uuid
+from threading import Thread, Event, Lock, Condition
+from queue import Queue, Empty, Full
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access
+
+    requests, aiohttp and asyncio make up most of the startup time, and a
+    run that finds nothing to upload never needs them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+asyncio = LazyModule("asyncio")
+requests = LazyModule("requests")
+
+# Optional, only needed for ENGINE = "asyncio"
+aiohttp = LazyModule("aiohttp") if importlib.util.find_spec("aiohttp") else None
+
+try:
+    import orjson  # Optional, parses metadata sidecars several times faster
+except ImportError:
+    orjson = None
+
+_preamble_names = set(globals())
 
 # Configuration
 SZURU_URL = "YOUR_SZURUBOORU_URL_HERE"  # e.g., "https://lboorus.lmms.wtf"
@@ -19,28 +65,890 @@ SZURU_USER = "YOUR_SZURUBOORU_USERNAME_HERE"
 SZURU_TOKEN = "YOUR_SZURUBOORU_API_TOKEN_HERE"  # e.g., "396ec236-80b6-4232-861e-39d613db3ffc"
 DOWNLOAD_DIR = "./booru_downloads"
 
+# Mirror every downloaded file to several Szurubooru instances. Each entry
+# is a dict with "name", "url", "user" and "token", and optionally
+# "rate_limit", "upload_workers" and "post_workers". Files are downloaded,
+# parsed, preprocessed and hashed once, then uploaded to every instance
+# in parallel. Empty = just SZURU_URL above.
+SZURU_TARGETS = []
+TARGET_BACKLOG = 10000  # Files a target may fall behind the fastest one before discovery waits for it
+
+# Upload worker pool
+UPLOAD_WORKERS = 4  # Files whose content is streamed to Szurubooru in parallel
+POST_WORKERS = 4  # Posts (and their missing tags) created in parallel from uploaded content
+UPLOAD_QUEUE_SIZE = 256  # Files waiting for a free worker in each stage
+METADATA_WORKERS = 2  # Threads parsing .json sidecars ahead of the upload workers
+SZURU_POOL_SIZE = None  # Keep-alive connections to Szurubooru (None = UPLOAD_WORKERS + POST_WORKERS)
+
+# Upload engine: "threads" runs UPLOAD_WORKERS blocking workers, "asyncio"
+# overlaps many uploads on one event loop (needs aiohttp)
+ENGINE = "threads"
+ASYNC_MAX_UPLOADS = 64  # Content uploads in flight at once with the asyncio engine
+ASYNC_MAX_POSTS = 64  # Post creations in flight at once with the asyncio engine
+
+# Retries for transient Szurubooru errors (timeouts, 429 and 5xx responses)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0  # Seconds before the first retry, doubled on each attempt
+RETRY_BACKOFF_MAX = 60.0
+RATE_LIMIT = None  # Max requests per second (None = unlimited until Szurubooru pushes back)
+RATE_LIMIT_MIN = 0.5  # Never throttle below this many requests per second
+
+# Upload timeouts grow with file size so large videos are not cut off
+UPLOAD_TIMEOUT = 60  # Seconds to wait for Szurubooru's answer on a small file
+UPLOAD_MIN_SPEED = 256 * 1024  # Slowest transfer rate (bytes/s) tolerated before timing out
+
+# Metrics: Prometheus text on http://localhost:METRICS_PORT/metrics and/or a
+# JSON line appended to METRICS_LOG every METRICS_INTERVAL seconds
+METRICS_PORT = None
+METRICS_BIND = "127.0.0.1"  # Address the metrics endpoint listens on ("" = all interfaces)
+METRICS_LOG = None
+METRICS_INTERVAL = 10
+PROFILE_OUTPUT = None  # Write merged cProfile stats of all pipeline threads here
+
+# Batch mode (--batch FILE): gallery-dl extractions run at once
+DOWNLOAD_WORKERS = 2
+
+# Subscription mode (--subscribe FILE): seconds between polls of each saved
+# search, unless its line in FILE gives its own interval after the URL
+SUBSCRIPTION_INTERVAL = 3600
+
+# Sync mode (--sync FILE): refresh tags and safety of posts mirrored earlier
+# from the source's current metadata, without downloading any media
+SYNC_BATCH_SIZE = 100  # Posts fetched from Szurubooru per request
+SYNC_WORKERS = 4  # Batches compared and updated in parallel
+SYNC_REMOVE_TAGS = False  # Also remove tags the source dropped (False = only add new ones)
+
+# Upload scheduling when several URLs download at once (batch and
+# subscription mode): files of the URL with the highest priority go first,
+# and URLs of equal priority share the workers in proportion to their
+# weight. Both are set per line of the URL list: "URL priority=10 weight=2"
+# (default priority 0, weight 1).
+UPLOAD_ORDER = "fifo"  # Within one URL: "fifo", "smallest" first (latency) or "largest" first (throughput)
+
+# File discovery: files are always queued as gallery-dl reports them on
+# stdout ("auto"/"stdout"). "inotify" (Linux) or "poll" additionally watch
+# DOWNLOAD_DIR for files placed there by anything else.
+DISCOVERY_BACKEND = "auto"
+POLL_INTERVAL = 0.5  # Seconds between directory scans when polling
+# Seconds a media file found before its .json sidecar waits for it, before
+# being uploaded without metadata
+SIDECAR_GRACE = 30
+
+# Duplicate handling before any bytes are uploaded: "skip" files already on
+# Szurubooru, "merge" their tags into the existing post, or "off"
+DEDUP_MODE = "skip"
+
+# Near-duplicates (same artwork at another resolution or encoding), found by
+# a perceptual hash of the image (needs Pillow): "off", "skip" them, or
+# "relate" (upload anyway and link the new post to its look-alike)
+NEAR_DUP_MODE = "off"
+NEAR_DUP_DISTANCE = 6  # Most of the 64 hash bits that may differ for two images to match
+
+# Tags: the source booru's tag categories (gallery-dl "tags_<category>"
+# metadata) mapped to Szurubooru tag categories, and source tag -> tag aliases
+TAG_CATEGORIES = {
+    "artist": "artist",
+    "character": "character",
+    "copyright": "copyright",
+    "general": "default",
+    "metadata": "meta",
+    "meta": "meta",
+}
+TAG_DEFAULT_CATEGORY = "default"
+TAG_ALIASES = {}
+TAG_CACHE_WARM = True  # Load all existing Szurubooru tags once at startup
+TAG_CREATE_WORKERS = 8  # Missing tags of one post created in parallel
+
+# Optional media preprocessing before upload, run in a process pool. Results
+# are cached by content hash so re-runs do not redo the work.
+PREPROCESS = False
+PREPROCESS_WORKERS = None  # Processes (None = one per CPU core)
+PREPROCESS_CACHE_DIR = "./preprocess_cache"
+PNG_OPTIMIZE = True  # Lossless PNG recompression (oxipng/optipng if installed, else Pillow)
+GIF_TO_VIDEO = None  # Convert GIFs to "mp4" or "webm" (needs ffmpeg)
+MAX_RESOLUTION = None  # Downscale images whose longest side exceeds this (needs Pillow)
+
+# Local cleanup once a file is on Szurubooru (posted, or already there):
+# "keep" it, "delete" it with its sidecar, or "archive" both to ARCHIVE_DIR.
+# Unless kept, its preprocessed copy in PREPROCESS_CACHE_DIR is deleted too.
+# Failed files always stay in place for the next run.
+RETENTION = "keep"
+ARCHIVE_DIR = "./booru_archive"
+# gallery-dl's record of downloaded posts, so files removed by RETENTION are
+# not fetched again (only used when RETENTION is not "keep")
+DOWNLOAD_ARCHIVE = "./gallery-dl-archive.sqlite3"
+# Pause gallery-dl (SIGSTOP) while downloaded files still in the upload
+# pipeline take more than this many bytes, until uploads catch up (None =
+# never pause). Files count until they are uploaded, skipped or failed, so
+# with RETENTION = "keep" this bounds the upload backlog, not disk usage.
+DISK_HIGH_WATER = None
+DISK_LOW_WATER = None  # Resume below this many bytes (None = 90% of DISK_HIGH_WATER)
+
+# Per-file upload state survives restarts here (None keeps it in memory only)
+STATE_DB = "./giggleupload_state.db"
+
 # Rule34 API credentials
 RULE34_API_KEY = "YOUR_RULE34_API_KEY_HERE"
 RULE34_USER_ID = "YOUR_RULE34_USER_ID_HERE"
 
+# Every setting above, overridable without editing this file (see load_config)
+CONFIG_NAMES = sorted(name for name in globals() if name.isupper() and name not in _preamble_names)
+CONFIG_ENV_PREFIX = "GIGGLEUPLOAD_"
+
+def load_config(path=None, environ=None):
+    """Override settings from a JSON file and then from GIGGLEUPLOAD_<NAME> environment variables
+
+    The file holds an object of setting names to values. An environment
+    variable is used as-is for settings that default to a string and
+    parsed as JSON otherwise (falling back to the raw string, so
+    GIGGLEUPLOAD_GIF_TO_VIDEO=mp4 works). Returns the names overridden.
+    """
+    environ = os.environ if environ is None else environ
+    overrides = {}
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+        if not isinstance(settings, dict):
+            raise ValueError(f"{path} must contain a JSON object of settings")
+        for name, value in settings.items():
+            if name in CONFIG_NAMES:
+                overrides[name] = value
+            else:
+                print(f"Warning: Ignoring unknown setting {name} in {path}")
+    
+    for name in CONFIG_NAMES:
+        raw = environ.get(CONFIG_ENV_PREFIX + name)
+        if raw is None:
+            continue
+        if isinstance(globals()[name], str):
+            overrides[name] = raw
+            continue
+        try:
+            overrides[name] = json.loads(raw)
+        except ValueError:
+            overrides[name] = raw
+    
+    globals().update(overrides)
+    # The shared pipeline queues were sized at import
+    for work_queue in (metadata_queue, preprocess_queue):
+        work_queue.maxsize = UPLOAD_QUEUE_SIZE
+    return sorted(overrides)
+
 # Szurubooru API headers
 import base64
 
-auth_string = f"{SZURU_USER}:{SZURU_TOKEN}"
-auth_token = base64.b64encode(auth_string.encode()).decode('ascii')
+def auth_headers(user, token):
+    """Szurubooru API headers for a user's login token"""
+    auth_string = f"{user}:{token}"
+    auth_token = base64.b64encode(auth_string.encode()).decode('ascii')
+    return {
+        "Authorization": f"Token {auth_token}",
+        "Accept": "application/json"
+    }
 
-headers = {
-    "Authorization": f"Token {auth_token}",
-    "Accept": "application/json"
-}
+class UploadStats:
+    """Thread-safe upload counters shared by all upload workers"""
+
+    def __init__(self, keys=("uploaded", "failed", "skipped", "retries", "total")):
+        self._lock = Lock()
+        self._counts = dict.fromkeys(keys, 0)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._counts[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._counts[key] = value
+
+    def increment(self, key, amount=1):
+        """Atomically add to a counter and return the new value"""
+        with self._lock:
+            self._counts[key] += amount
+            return self._counts[key]
+
+    def snapshot(self):
+        """Return a consistent copy of all counters"""
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            for key in self._counts:
+                self._counts[key] = 0
+
+class ProcessedFiles:
+    """Thread-safe set of files queued for upload this run, counting those still in the pipeline
+
+    Files every target has are forgotten once they leave the pipeline
+    (queue_upload skips them through the state store), so a subscription
+    daemon does not remember everything it ever mirrored.
+    """
+
+    def __init__(self):
+        self._lock = Condition()
+        self._keys = set()
+        self._in_flight = 0
+        self._claimed = 0
+
+    def claim(self, key):
+        """Mark a file as processed, returning False if it already was"""
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            self._in_flight += 1
+            self._claimed += 1
+            return True
+
+    def finish(self, key, forget=False):
+        """Note that a claimed file has left the pipeline, whatever the outcome"""
+        with self._lock:
+            if forget:
+                self._keys.discard(key)
+            self._in_flight -= 1
+            if self._in_flight <= 0:
+                self._lock.notify_all()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return self._in_flight
+
+    @property
+    def claimed(self):
+        """Files claimed this run, including forgotten ones"""
+        with self._lock:
+            return self._claimed
+
+    def wait_idle(self, timeout=None):
+        """Wait until every claimed file has left the pipeline, returning False on timeout"""
+        with self._lock:
+            return self._lock.wait_for(lambda: self._in_flight <= 0, timeout)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self._in_flight = 0
+            self._claimed = 0
+            self._lock.notify_all()
+
+def state_key(path):
+    """Canonical path of a file, so it has one state row and one claim however it was reached
+
+    A relative path from a batch run, another working directory under cron
+    and an absolute --upload path all name the same file.
+    """
+    return Path(os.path.realpath(path))
+
+class StateStore:
+    """Durable per-file upload state in SQLite, so restarts resume where they stopped
+
+    Files move through discovered -> uploaded (content token received) ->
+    posted, or end up as skipped (duplicate) or failed (with a reason).
+    Every upload target keeps its files in a table of its own.
+    """
+
+    FINISHED = ("posted", "skipped")
+    PENDING = ("discovered", "uploaded", "failed")
+
+    def __init__(self, path, table="files"):
+        self._lock = Lock()
+        self.table = table
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                path TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                checksum TEXT,
+                token TEXT,
+                post_id INTEGER,
+                reason TEXT,
+                updated REAL NOT NULL,
+                phash TEXT,
+                origin TEXT
+            );
+            CREATE INDEX IF NOT EXISTS {table}_status ON {table} (status);
+            CREATE INDEX IF NOT EXISTS {table}_checksum ON {table} (checksum);
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                url TEXT PRIMARY KEY,
+                high_water INTEGER,
+                checked REAL NOT NULL
+            );
+        """)
+        # Databases from before perceptual hashing and sync mode lack the columns
+        columns = [row[1] for row in self._db.execute(f"PRAGMA table_info({table})")]
+        for column in ("phash", "origin"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_origin ON {table} (origin)")
+        
+        # Paths used to be stored as given. Make every table's relative ones
+        # canonical once (against the working directory, where STATE_DB
+        # usually lives too). When the file has a row under both paths, keep
+        # the finished one, or else the one updated last.
+        if self._db.execute("PRAGMA user_version").fetchone()[0] < 1:
+            self._db.execute("BEGIN IMMEDIATE")
+            tables = [row[0] for row in self._db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'files*'")]
+            for name in tables:
+                rows = self._db.execute(f"SELECT path, status, updated FROM {name}").fetchall()
+                for path, status, updated in rows:
+                    key = str(state_key(path))
+                    if key == path:
+                        continue
+                    current = self._db.execute(f"SELECT status, updated FROM {name} WHERE path = ?",
+                                               (key,)).fetchone()
+                    if current is not None:
+                        if (current[0] in self.FINISHED, current[1]) >= (status in self.FINISHED, updated):
+                            self._db.execute(f"DELETE FROM {name} WHERE path = ?", (path,))
+                            continue
+                        self._db.execute(f"DELETE FROM {name} WHERE path = ?", (key,))
+                    self._db.execute(f"UPDATE {name} SET path = ? WHERE path = ?", (key, path))
+            self._db.execute("PRAGMA user_version = 1")
+            self._db.execute("COMMIT")
+
+    def mark(self, path, status, checksum=None, token=None, post_id=None, reason=None, phash=None, origin=None):
+        """Record a file's new status, keeping previously stored fields that are not given"""
+        # 64-bit hashes do not fit SQLite's signed integers, so keep them as hex
+        phash = f"{phash:016x}" if phash is not None else None
+        with self._lock:
+            self._db.execute(f"""
+                INSERT INTO {self.table} (path, status, checksum, token, post_id, reason, updated, phash, origin)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    status = excluded.status,
+                    checksum = COALESCE(excluded.checksum, checksum),
+                    token = COALESCE(excluded.token, token),
+                    post_id = COALESCE(excluded.post_id, post_id),
+                    reason = excluded.reason,
+                    updated = excluded.updated,
+                    phash = COALESCE(excluded.phash, phash),
+                    origin = COALESCE(excluded.origin, origin)
+            """, (str(state_key(path)), status, checksum, token, post_id, reason, time.time(), phash, origin))
+
+    def status(self, path):
+        with self._lock:
+            row = self._db.execute(f"SELECT status FROM {self.table} WHERE path = ?",
+                                   (str(state_key(path)),)).fetchone()
+        return row[0] if row else None
+
+    def is_finished(self, path):
+        return self.status(path) in self.FINISHED
+
+    def pending(self):
+        """Paths of files that were discovered but never finished"""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT path FROM {self.table} WHERE status IN ({','.join('?' * len(self.PENDING))})",
+                self.PENDING
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def post_for_checksum(self, checksum):
+        """Post id of an already uploaded file with this checksum, or None"""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT post_id FROM {self.table} WHERE checksum = ? AND post_id IS NOT NULL LIMIT 1",
+                (checksum,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def stored_upload(self, path):
+        """(checksum, content token, perceptual hash) kept for a file whose post was never created"""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT checksum, token, phash FROM {self.table} WHERE path = ? AND status != 'posted'",
+                (str(state_key(path)),)
+            ).fetchone()
+        if not row:
+            return None, None, None
+        return row[0], row[1], int(row[2], 16) if row[2] else None
+
+    def perceptual_hashes(self):
+        """(perceptual hash, post id) of every posted file that has a hash"""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT phash, post_id FROM {self.table} WHERE phash IS NOT NULL AND status = 'posted'"
+            ).fetchall()
+        return [(int(phash, 16), post_id) for phash, post_id in rows]
+
+    def posts_for_origins(self, origins):
+        """Map source posts ("category:id", see metadata_origin) to the Szurubooru posts made from them"""
+        origins = list(origins)
+        if not origins:
+            return {}
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT origin, post_id FROM {self.table} WHERE status = 'posted' "
+                f"AND origin IN ({','.join('?' * len(origins))})",
+                origins
+            ).fetchall()
+        return dict(rows)
+
+    def origin(self, path):
+        """Source post ("category:id") a file was uploaded from, or None"""
+        with self._lock:
+            row = self._db.execute(f"SELECT origin FROM {self.table} WHERE path = ?",
+                                   (str(state_key(path)),)).fetchone()
+        return row[0] if row else None
+
+    def posted_without_origin(self):
+        """Paths of posted files recorded before their origin was kept"""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT path FROM {self.table} WHERE status = 'posted' AND origin IS NULL"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def set_origin(self, path, origin):
+        with self._lock:
+            self._db.execute(f"UPDATE {self.table} SET origin = ? WHERE path = ?", (origin, str(state_key(path))))
+
+    def clear_token(self, path):
+        with self._lock:
+            self._db.execute(f"UPDATE {self.table} SET token = NULL WHERE path = ?", (str(state_key(path)),))
+
+    def high_water(self, url):
+        """Newest post id a subscription has fetched, or None before its first poll"""
+        with self._lock:
+            row = self._db.execute("SELECT high_water FROM subscriptions WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def set_high_water(self, url, post_id):
+        with self._lock:
+            self._db.execute("""
+                INSERT INTO subscriptions (url, high_water, checked) VALUES (?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    high_water = MAX(COALESCE(high_water, 0), COALESCE(excluded.high_water, 0)),
+                    checked = excluded.checked
+            """, (url, post_id, time.time()))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+_state_store = None
+_state_store_lock = Lock()
+
+def get_state_store():
+    """Return the shared state store, opening it on first use"""
+    global _state_store
+    with _state_store_lock:
+        if _state_store is None:
+            _state_store = StateStore(STATE_DB or ":memory:")
+        return _state_store
+
+class Metrics:
+    """Thread-safe counters, gauges and per-stage timing histograms"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def gauge(self, name, read):
+        """Register a callable whose value is read whenever metrics are exported"""
+        with self._lock:
+            self._gauges[name] = read
+
+    def observe(self, name, seconds):
+        """Record how long one item spent in a stage"""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(self.BUCKETS)}
+            timing["count"] += 1
+            timing["sum"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    timing["buckets"][i] += 1
+                    break
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        """Plain dict of all current values, as written to the JSON-lines log"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = {name: dict(timing, buckets=list(timing["buckets"])) for name, timing in self._timings.items()}
+        return {
+            "time": time.time(),
+            "counters": counters,
+            "gauges": {name: read() for name, read in gauges.items()},
+            "timings": {
+                name: {
+                    "count": timing["count"],
+                    "avg": timing["sum"] / timing["count"] if timing["count"] else 0.0,
+                    "max": timing["max"],
+                }
+                for name, timing in timings.items()
+            },
+        }
+
+    def prometheus_text(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = {name: dict(timing, buckets=list(timing["buckets"])) for name, timing in self._timings.items()}
+        
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE giggleupload_{name}_total counter")
+            lines.append(f"giggleupload_{name}_total {value}")
+        for name, read in sorted(gauges.items()):
+            lines.append(f"# TYPE giggleupload_{name} gauge")
+            lines.append(f"giggleupload_{name} {read()}")
+        for name, timing in sorted(timings.items()):
+            metric = f"giggleupload_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, timing["buckets"]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {timing["count"]}')
+            lines.append(f"{metric}_sum {timing['sum']}")
+            lines.append(f"{metric}_count {timing['count']}")
+        return "\n".join(lines) + "\n"
+
+def serve_metrics(port, bind=""):
+    """Serve /metrics for Prometheus from a daemon thread"""
+    # http.server is slow to import and only needed here
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((bind, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+_metrics_started = False
+
+def start_metrics_exporters():
+    """Start the Prometheus endpoint and JSON-lines logger if configured, once per process"""
+    global _metrics_started
+    if _metrics_started:
+        return
+    _metrics_started = True
+    
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT, METRICS_BIND)
+        print(f"?? Metrics at http://{METRICS_BIND or 'localhost'}:{METRICS_PORT}/metrics")
+    
+    if METRICS_LOG:
+        def write_metrics_log():
+            while True:
+                time.sleep(METRICS_INTERVAL)
+                with open(METRICS_LOG, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(metrics.snapshot()) + "\n")
+        Thread(target=write_metrics_log, name="metrics-log", daemon=True).start()
+
+_profiles = []
+_profiles_lock = Lock()
+
+def run_profiled(func, *args):
+    """Run func under its own cProfile profiler when PROFILE_OUTPUT is set"""
+    if not PROFILE_OUTPUT:
+        return func(*args)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        with _profiles_lock:
+            _profiles.append(profiler)
+
+def write_profile():
+    """Merge the profiles of all finished threads into PROFILE_OUTPUT"""
+    with _profiles_lock:
+        profiles = list(_profiles)
+        _profiles.clear()
+    if not PROFILE_OUTPUT or not profiles:
+        return
+    import pstats
+    stats = pstats.Stats(profiles[0])
+    for profiler in profiles[1:]:
+        stats.add(profiler)
+    stats.dump_stats(PROFILE_OUTPUT)
+    print(f"?? Profile of {len(profiles)} threads written to {PROFILE_OUTPUT}")
+
+class DiskGuard:
+    """Pauses gallery-dl while downloaded files in the pipeline exceed DISK_HIGH_WATER
+
+    Usage is the size of the files (with their sidecars and preprocessed
+    copies) this run queued that have not left the pipeline yet, so no
+    directory walk is needed. A file stops counting when it is finished,
+    whatever RETENTION does with it, so files that stay on disk (failures,
+    RETENTION = "keep") never hold gallery-dl back. gallery-dl continues
+    once usage drops under DISK_LOW_WATER, or as soon as no upload is left
+    in flight.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sizes = {}
+        self._processes = set()
+        self.bytes = 0
+        self.paused = False
+
+    def reset(self):
+        with self._lock:
+            self._sizes.clear()
+            self.bytes = 0
+            self.paused = False
+
+    def track(self, filepath, *paths):
+        """Count a file together with its sidecar and any preprocessed copy"""
+        size = 0
+        for path in (filepath, *paths):
+            try:
+                size += os.stat(path).st_size
+            except OSError:
+                pass
+        with self._lock:
+            self.bytes += size - self._sizes.get(str(filepath), 0)
+            self._sizes[str(filepath)] = size
+
+    def release(self, filepath):
+        with self._lock:
+            self.bytes -= self._sizes.pop(str(filepath), 0)
+
+    def register(self, process):
+        with self._lock:
+            self._processes.add(process)
+            if self.paused:
+                self._signal(process, "SIGSTOP")
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+            # A stopped process would never see terminate()
+            if self.paused:
+                self._signal(process, "SIGCONT")
+
+    def check(self):
+        """Pause or resume gallery-dl depending on disk usage and the uploads in flight"""
+        if not DISK_HIGH_WATER or not hasattr(signal, "SIGSTOP"):
+            return
+        low_water = DISK_LOW_WATER or DISK_HIGH_WATER * 0.9
+        in_flight = processed_files.in_flight
+        with self._lock:
+            if not self.paused and self.bytes > DISK_HIGH_WATER and in_flight > 0:
+                self.paused = True
+                action = "SIGSTOP"
+                print(f"\n?? {self.bytes / 2**20:.1f} MiB waiting for upload, pausing gallery-dl")
+            elif self.paused and (self.bytes < low_water or in_flight <= 0):
+                self.paused = False
+                action = "SIGCONT"
+                print(f"\n?? Uploads caught up ({self.bytes / 2**20:.1f} MiB left), resuming gallery-dl")
+            else:
+                return
+            metrics.inc(f"gallery_dl_{'paused' if self.paused else 'resumed'}")
+            for process in self._processes:
+                self._signal(process, action)
+
+    def _signal(self, process, name):
+        if process.poll() is None and hasattr(signal, name):
+            try:
+                process.send_signal(getattr(signal, name))
+            except OSError:
+                pass
+
+# A file moving through the pipeline; upload_path differs from filepath
+# when preprocessing produced a smaller or converted copy. Once fanned out,
+# each target gets its own copy, all sharing one FanOut. download_url is
+# the gallery-dl URL the file came from (None if found any other way).
+UploadJob = namedtuple(
+    'UploadJob',
+    ['filepath', 'metadata_path', 'metadata', 'queued_at', 'upload_path', 'checksum', 'token', 'reused_token',
+     'phash', 'relations', 'target', 'fanout', 'origin', 'download_url'],
+    defaults=(None, None, False, None, None, None, None, None, None)
+)
+
+# Download URL -> (priority, weight) for FairQueue, from the URL list options
+source_priorities = {}
+
+class FairQueue:
+    """Bounded pipeline queue that hands out the most urgent files first, sharing fairly between download URLs
+
+    Files wait in one lane per download URL. get() serves the non-empty
+    lanes with the highest priority first and splits the workers between
+    lanes of equal priority by weight: every file taken adds 1 / weight to
+    its lane's virtual time, and the lane with the lowest goes next. A lane
+    that was idle starts level with the busy ones instead of catching up.
+    Within a lane, files come out per UPLOAD_ORDER. put() only blocks while
+    the file's own lane is full, so a bulk download waiting for room never
+    holds up an urgent one.
+    
+    Offers the parts of queue.Queue the pipeline uses; None stop sentinels
+    come out only after every lane is empty.
+    """
+
+    class _Lane:
+        def __init__(self):
+            self.items = []  # heap of (order key, seq, job)
+            self.vtime = 0.0
+            self.priority = 0
+            self.weight = 1
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._cond = Condition()
+        self._lanes = {}
+        self._active = set()
+        self._stops = 0
+        self._size = 0
+        self._seq = itertools.count()
+
+    def _order_key(self, job):
+        if UPLOAD_ORDER not in ("smallest", "largest"):
+            return 0
+        try:
+            size = os.path.getsize(job.upload_path)
+        except OSError:
+            size = 0
+        return size if UPLOAD_ORDER == "smallest" else -size
+
+    def put(self, job, block=True):
+        if job is None:
+            with self._cond:
+                self._stops += 1
+                self._cond.notify_all()
+            return
+        key = self._order_key(job)
+        with self._cond:
+            lane = self._lanes.get(job.download_url)
+            if lane is None:
+                lane = self._lanes[job.download_url] = self._Lane()
+            lane.priority, lane.weight = source_priorities.get(job.download_url, (0, 1))
+            while self.maxsize and len(lane.items) >= self.maxsize:
+                if not block:
+                    raise Full
+                self._cond.wait()
+            if not lane.items:
+                # Rejoin at the current virtual time of the busy lanes
+                busy = [self._lanes[url].vtime for url in self._active]
+                lane.vtime = max(lane.vtime, min(busy, default=0.0))
+                self._active.add(job.download_url)
+            heapq.heappush(lane.items, (key, next(self._seq), job))
+            self._size += 1
+            self._cond.notify_all()
+
+    def _take(self):
+        if self._active:
+            url = max(self._active, key=lambda url: (self._lanes[url].priority, -self._lanes[url].vtime))
+            lane = self._lanes[url]
+            job = heapq.heappop(lane.items)[2]
+            lane.vtime += 1.0 / max(lane.weight, 1e-9)
+            if not lane.items:
+                self._active.discard(url)
+            self._size -= 1
+            self._cond.notify_all()
+            return job
+        self._stops -= 1
+        return None
+
+    def get(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._active or self._stops)
+            return self._take()
+
+    def get_nowait(self):
+        with self._cond:
+            if not (self._active or self._stops):
+                raise Empty
+            return self._take()
+
+    def task_done(self):
+        # Nothing joins pipeline queues
+        pass
+
+    def qsize(self):
+        with self._cond:
+            return self._size
+
+class FanOut:
+    """Shared by a file's copies in every target's queue
+
+    Content hashes are computed by whichever target needs them first and
+    reused by the rest, and the file leaves the pipeline when the last
+    target is done with it.
+    """
+
+    def __init__(self, count):
+        self._lock = Lock()
+        self._remaining = count
+        self._values = {}
+        self._key_locks = {}
+
+    def once(self, key, compute):
+        """compute() for the first target that asks, the stored result for the others"""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, Lock())
+        with key_lock:
+            if key not in self._values:
+                self._values[key] = compute()
+            return self._values[key]
+
+    def done(self):
+        """Note that one target is finished, returning True for the last one"""
+        with self._lock:
+            self._remaining -= 1
+            return self._remaining == 0
 
 # Track processed files
-processed_files = set()
+processed_files = ProcessedFiles()
 stop_event = Event()
-upload_stats = {"uploaded": 0, "failed": 0, "total": 0}
+upload_stats = UploadStats()
+metadata_queue = FairQueue(maxsize=UPLOAD_QUEUE_SIZE)
+preprocess_queue = FairQueue(maxsize=UPLOAD_QUEUE_SIZE)
+metrics = Metrics()
+disk_guard = DiskGuard()
+metrics.gauge("metadata_queue_depth", metadata_queue.qsize)
+metrics.gauge("preprocess_queue_depth", preprocess_queue.qsize)
+metrics.gauge("upload_queue_depth", lambda: sum(target.upload_queue.qsize() for target in _targets or ()))
+metrics.gauge("post_queue_depth", lambda: sum(target.post_queue.qsize() for target in _targets or ()))
+metrics.gauge("disk_pending_bytes", lambda: disk_guard.bytes)
+for _key in ("uploaded", "failed", "skipped"):
+    metrics.gauge(f"files_{_key}", lambda key=_key: upload_stats[key])
 
 def setup_gallery_dl_config():
-    """Setup gallery-dl configuration with Rule34 API credentials"""
+    """Setup gallery-dl configuration with Rule34 API credentials, rewriting it only if they changed"""
     config_dir = Path.home() / ".config" / "gallery-dl"
     if os.name == 'nt':  # Windows
         config_dir = Path(os.environ.get('APPDATA', '')) / "gallery-dl"
@@ -50,12 +958,14 @@ def setup_gallery_dl_config():
     
     # Create or update config
     config = {}
+    current = None
     if config_file.exists():
         with open(config_file, 'r') as f:
-            try:
-                config = json.load(f)
-            except:
-                config = {}
+            current = f.read()
+        try:
+            config = json.loads(current)
+        except:
+            config = {}
     
     # Add Rule34 credentials
     if "extractor" not in config:
@@ -66,36 +976,244 @@ def setup_gallery_dl_config():
     config["extractor"]["rule34"]["api-key"] = RULE34_API_KEY
     config["extractor"]["rule34"]["user-id"] = RULE34_USER_ID
     
-    # Save config
+    # Save config, unless it already says exactly this
+    content = json.dumps(config, indent=2)
+    if content == current:
+        return False
     with open(config_file, 'w') as f:
-        json.dump(config, f, indent=2)
+        f.write(content)
     
-    print(f" Gallery-dl config updated")
+    print(f"✓ Gallery-dl config updated")
+    return True
 
-def get_file_token(filepath):
-    """Upload file and get token from Szurubooru"""
+class RateLimiter:
+    """Token bucket shared by all workers that slows down when Szurubooru pushes back
+
+    The rate is halved when the server answers 429/503 (at most once per
+    second, so a burst of rejected in-flight requests counts once) and all
+    requests pause for its Retry-After. Each successful request then adds
+    1/rate, i.e. the rate grows by about one request per second every
+    second, never exceeding the configured maximum.
+    """
+
+    WINDOW = 5.0  # Seconds of history used to estimate the current request rate
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, rate=None, min_rate=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or RATE_LIMIT_MIN
+        self._lock = Lock()
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._recent = deque()
+
+    def reserve(self):
+        """Take a request slot if one is free, else return the seconds to wait before asking again"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.rate is None:
+                self._record(now)
+                return 0.0
+            # Allow a burst of at most one second's worth of requests
+            self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self._record(now)
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until the caller may send one request"""
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait without blocking the event loop until the caller may send one request"""
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def _record(self, now):
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - self.WINDOW:
+            self._recent.popleft()
+
+    def backoff(self, retry_after=None):
+        """Halve the request rate after the server signalled overload"""
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if now - self._last_decrease < self.DECREASE_INTERVAL:
+                return
+            self._last_decrease = now
+            current = self.rate
+            if current is None:
+                # First pushback while unlimited: start from the rate observed
+                # over the window (or since the first request, if sooner)
+                span = now - self._recent[0] if len(self._recent) > 1 else self.WINDOW
+                current = max(len(self._recent) / max(span, 1.0), self.min_rate)
+            self.rate = max(current / 2, self.min_rate)
+            self._tokens = min(self._tokens, 1.0)
+            self._updated = now
+
+    def recover(self):
+        """Slowly raise the rate again after a successful request"""
+        with self._lock:
+            if self.rate is None:
+                return
+            self.rate += 1.0 / self.rate
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
     try:
-        with open(filepath, 'rb') as f:
-            files = {'content': f}
-            response = requests.post(
-                f"{SZURU_URL}/api/uploads",
-                headers=headers,
-                files=files,
-                timeout=60
-            )
-            
-            if response.status_code == 200:
-                return response.json()['token']
-            else:
-                print(f"Upload error: {response.status_code} - {response.text}")
-                return None
-    except Exception as e:
-        print(f"Error uploading file: {e}")
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
         return None
 
-def create_post(token, tags, safety="safe", source=None):
-    """Create a post in Szurubooru"""
-    try:
+def backoff_delay(attempt):
+    """Capped exponential backoff with full jitter"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+
+def response_retry_delay(rate_limiter, response, attempt, method, path):
+    """Seconds to wait before retrying after this response, or None if it is final"""
+    if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+        if response.status_code < 400:
+            rate_limiter.recover()
+        return None
+    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+    if response.status_code in (429, 503):
+        rate_limiter.backoff(retry_after)
+    delay = retry_after if retry_after is not None else backoff_delay(attempt)
+    print(f"Retrying {method} {path} in {delay:.1f}s after HTTP {response.status_code}")
+    return delay
+
+def count_retry(response=None, stats=None):
+    (stats or upload_stats).increment('retries')
+    metrics.inc("retries")
+    metrics.inc(f"retries_{response.status_code}" if response is not None else "retries_connection")
+
+class MultipartFile:
+    """multipart/form-data body that streams a single file from disk
+
+    requests reads the body in small blocks through read(), so memory per
+    upload stays constant no matter how large the file is, unlike
+    files=... which builds the whole body in memory first.
+    """
+
+    def __init__(self, path, field='content'):
+        boundary = uuid.uuid4().hex
+        filename = os.path.basename(path).replace('"', '%22')
+        head = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('ascii')
+        
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._length = len(head) + self.size + len(tail)
+        self._parts = deque([io.BytesIO(head), self._file, io.BytesIO(tail)])
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.popleft()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    async def iter_chunks(self, chunk_size=256 * 1024):
+        """Yield the body for aiohttp, reading the file off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, self.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def upload_timeout(size):
+    """(connect, read) timeout for uploading size bytes"""
+    return (10, UPLOAD_TIMEOUT + size / UPLOAD_MIN_SPEED)
+
+class ApiCall(namedtuple('ApiCall', ['method', 'path', 'options', 'parse', 'failure', 'error', 'conflict'],
+                         defaults=(None,))):
+    """One Szurubooru API call: the request, how to read its result and how to report a failure
+
+    failure prefixes an error response and error an exception; conflict, if
+    set, is the result when the resource already exists.
+    """
+
+def api_result(api_call, response):
+    """What a call returns for its final response: the parsed result, or None after printing why not"""
+    if response.status_code == 200:
+        return api_call.parse(response.json())
+    if api_call.conflict is not None and (response.status_code == 409 or 'AlreadyExistsError' in response.text):
+        # Another worker (or user) created it first
+        return api_call.conflict
+    print(f"{api_call.failure}: {response.status_code} - {response.text}")
+    return None
+
+def first_result(page):
+    """First post of a search page, or None"""
+    results = page.get('results', [])
+    return results[0] if results else None
+
+class SzuruApi:
+    """Szurubooru API calls shared by both upload engines
+
+    Each method builds its call and hands it to the subclass's call(),
+    which does the I/O: SzuruClient returns the result, AsyncSzuruClient
+    a coroutine for it.
+    """
+
+    def get_file_token(self, filepath):
+        """Upload file and get token from Szurubooru"""
+        return self.call(ApiCall("POST", "/api/uploads", {"content_path": filepath},
+                                 lambda data: data['token'], "Upload error", "uploading file"))
+
+    def create_post(self, token, tags, safety="safe", source=None, relations=None):
+        """Create a post in Szurubooru"""
         data = {
             "tags": tags,
             "safety": safety,
@@ -104,668 +1222,2277 @@ def create_post(token, tags, safety="safe", source=None):
         
         if source:
             data["source"] = source
+        if relations:
+            data["relations"] = relations
         
-        response = requests.post(
-            f"{SZURU_URL}/api/posts",
-            headers=headers,
-            json=data,
-            timeout=30
+        return self.call(ApiCall("POST", "/api/posts", {"json": data},
+                                 dict, "Post creation error", "creating post"))
+
+    def find_post_by_checksum(self, checksum):
+        """Return the post whose content has this SHA1 checksum, or None"""
+        params = {"query": f"content-checksum:{checksum}", "limit": 1, "fields": "id,version,tags"}
+        return self.call(ApiCall("GET", "/api/posts/", {"params": params},
+                                 first_result, "Duplicate check error", "checking for duplicate"))
+
+    def get_post(self, post_id, fields="id,version,tags"):
+        """Fetch a post from Szurubooru"""
+        return self.call(ApiCall("GET", f"/api/post/{post_id}", {"params": {"fields": fields}},
+                                 dict, "Post lookup error", "fetching post"))
+
+    def get_posts(self, post_ids, fields="id,version,tags,safety"):
+        """Fetch several posts with one search, returning post id -> post (None on error)"""
+        params = {
+            "query": "id:" + ",".join(str(post_id) for post_id in post_ids),
+            "limit": len(post_ids),
+            "fields": fields
+        }
+        return self.call(ApiCall("GET", "/api/posts/", {"params": params},
+                                 lambda page: {post['id']: post for post in page.get('results', [])},
+                                 "Post lookup error", "fetching posts"))
+
+    def update_post(self, post_id, version, **fields):
+        """Update fields of an existing post in Szurubooru"""
+        return self.call(ApiCall("PUT", f"/api/post/{post_id}", {"json": dict(fields, version=version)},
+                                 dict, "Post update error", "updating post"))
+
+    def list_tags(self, offset=0, limit=100):
+        """Fetch one page of tags from Szurubooru"""
+        params = {"offset": offset, "limit": limit, "fields": "names,category"}
+        return self.call(ApiCall("GET", "/api/tags/", {"params": params},
+                                 dict, "Tag list error", "listing tags"))
+
+    def create_tag(self, name, category):
+        """Create a tag in Szurubooru"""
+        return self.call(ApiCall("POST", "/api/tags", {"json": {"names": [name], "category": category}},
+                                 dict, "Tag creation error", "creating tag",
+                                 conflict={"names": [name], "category": category}))
+
+class SzuruClient(SzuruApi):
+    """Szurubooru API client that keeps a pool of warm keep-alive connections"""
+
+    def __init__(self, base_url=None, api_headers=None, pool_size=None, rate_limit=None, stats=None):
+        self.base_url = (base_url or SZURU_URL).rstrip('/')
+        self.rate_limiter = RateLimiter(rate_limit or RATE_LIMIT)
+        self.stats = stats or upload_stats
+        self.session = requests.Session()
+        self.session.headers.update(api_headers or auth_headers(SZURU_USER, SZURU_TOKEN))
+        
+        # One pooled connection per worker; block instead of opening
+        # throwaway connections when every pooled one is busy
+        pool_size = pool_size or SZURU_POOL_SIZE or UPLOAD_WORKERS + POST_WORKERS
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _send(self, method, path, content_path=None, timeout=30, **kwargs):
+        """Send a request, retrying timeouts, connection errors, 429s and 5xx with backoff"""
+        attempt = 0
+        while True:
+            response = None
+            with metrics.timer("rate_limit_wait"):
+                self.rate_limiter.acquire()
+            try:
+                if content_path is not None:
+                    # Reopen the file on every attempt so retries resend it from the start
+                    with MultipartFile(content_path) as body:
+                        response = self.session.request(
+                            method, f"{self.base_url}{path}",
+                            data=body,
+                            headers={'Content-Type': body.content_type},
+                            timeout=upload_timeout(body.size),
+                            **kwargs
+                        )
+                else:
+                    response = self.session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"Retrying {method} {path} in {delay:.1f}s after error: {e}")
+            else:
+                delay = response_retry_delay(self.rate_limiter, response, attempt, method, path)
+                if delay is None:
+                    return response
+            attempt += 1
+            count_retry(response, self.stats)
+            time.sleep(delay)
+
+    def call(self, api_call):
+        """Send an API call, returning its result or None on failure"""
+        try:
+            return api_result(api_call, self._send(api_call.method, api_call.path, **api_call.options))
+        except Exception as e:
+            print(f"Error {api_call.error}: {e}")
+            return None
+
+    def close(self):
+        self.session.close()
+
+def get_client():
+    """Return the first target's Szurubooru client, creating it on first use"""
+    return get_targets()[0].client()
+
+def get_file_token(filepath, client=None):
+    """Upload file and get token from Szurubooru"""
+    with metrics.timer("upload_token"):
+        return (client or get_client()).get_file_token(filepath)
+
+def create_post(token, tags, safety="safe", source=None, relations=None, client=None):
+    """Create a post in Szurubooru"""
+    with metrics.timer("post_create"):
+        return (client or get_client()).create_post(token, tags, safety, source, relations)
+
+class AsyncResponse(namedtuple('AsyncResponse', ['status_code', 'headers', 'text'])):
+    """Fully read aiohttp response, shaped like the parts of requests.Response we use"""
+
+    def json(self):
+        return json.loads(self.text)
+
+class AsyncSzuruClient(SzuruApi):
+    """aiohttp counterpart of SzuruClient for the asyncio engine
+
+    Semaphores cap how many content uploads and post creations are in
+    flight; retries and rate limiting follow the same rules as SzuruClient.
+    Must be created inside the running event loop.
+    """
+
+    def __init__(self, base_url=None, api_headers=None, rate_limiter=None,
+                 max_uploads=None, max_posts=None, stats=None):
+        if aiohttp is None:
+            raise RuntimeError('ENGINE = "asyncio" needs aiohttp (pip install aiohttp)')
+        self.base_url = (base_url or SZURU_URL).rstrip('/')
+        self.rate_limiter = rate_limiter or RateLimiter(RATE_LIMIT)
+        self.stats = stats or upload_stats
+        max_uploads = max_uploads or ASYNC_MAX_UPLOADS
+        max_posts = max_posts or ASYNC_MAX_POSTS
+        self.upload_slots = asyncio.Semaphore(max_uploads)
+        self.post_slots = asyncio.Semaphore(max_posts)
+        self.session = aiohttp.ClientSession(
+            headers=api_headers or auth_headers(SZURU_USER, SZURU_TOKEN),
+            connector=aiohttp.TCPConnector(limit=max_uploads + max_posts)
         )
+
+    async def _request(self, method, path, **kwargs):
+        async with self.session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+            return AsyncResponse(response.status, dict(response.headers), await response.text())
+
+    async def _send(self, method, path, content_path=None, timeout=30, **kwargs):
+        """Send a request, retrying timeouts, connection errors, 429s and 5xx with backoff"""
+        attempt = 0
+        while True:
+            response = None
+            with metrics.timer("rate_limit_wait"):
+                await self.rate_limiter.acquire_async()
+            try:
+                if content_path is not None:
+                    # Reopen the file on every attempt so retries resend it from the start
+                    with MultipartFile(content_path) as body:
+                        connect, read = upload_timeout(body.size)
+                        response = await self._request(
+                            method, path,
+                            data=body.iter_chunks(),
+                            headers={'Content-Type': body.content_type, 'Content-Length': str(len(body))},
+                            timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+                            **kwargs
+                        )
+                else:
+                    response = await self._request(
+                        method, path, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"Retrying {method} {path} in {delay:.1f}s after error: {e!r}")
+            else:
+                delay = response_retry_delay(self.rate_limiter, response, attempt, method, path)
+                if delay is None:
+                    return response
+            attempt += 1
+            count_retry(response, self.stats)
+            await asyncio.sleep(delay)
+
+    async def call(self, api_call):
+        """Send an API call, returning its result or None on failure"""
+        try:
+            return api_result(api_call, await self._send(api_call.method, api_call.path, **api_call.options))
+        except Exception as e:
+            print(f"Error {api_call.error}: {e!r}")
+            return None
+
+    async def get_file_token(self, filepath):
+        async with self.upload_slots:
+            with metrics.timer("upload_token"):
+                return await super().get_file_token(filepath)
+
+    async def create_post(self, token, tags, safety="safe", source=None, relations=None):
+        async with self.post_slots:
+            with metrics.timer("post_create"):
+                return await super().create_post(token, tags, safety, source, relations)
+
+    async def close(self):
+        await self.session.close()
+
+class TagCache:
+    """Tags Szurubooru already knows, so each unique tag is normalized and created only once"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._known = {}  # Any known tag name or alias -> primary name
+        self._normalized = {}  # Raw source tag -> normalized name
+        self._creating = {}  # Tag name -> Event set once its creation finished
+        self._creating_async = {}  # Tag name -> Future done once its creation finished
+        self._warm_lock = Lock()
+        self._warmed = False
+        self.warm_tags = None  # Set per pipeline; None follows TAG_CACHE_WARM
+        self._executor = None
+
+    def warm(self, client):
+        """Load every existing tag from Szurubooru, once per process"""
+        # Other workers wait here until the first one has loaded everything
+        with self._warm_lock:
+            if self._warmed:
+                return
+            self._warmed = True
+            
+            offset = 0
+            while True:
+                page = client.list_tags(offset)
+                if not page:
+                    return
+                self.learn(page.get('results', []))
+                offset += len(page.get('results', []))
+                if not page.get('results') or offset >= page.get('total', 0):
+                    break
+            print(f"?? Loaded {offset} existing tags")
+
+    def _should_warm(self):
+        return TAG_CACHE_WARM if self.warm_tags is None else self.warm_tags
+
+    def learn(self, tags):
+        """Remember tag resources returned by Szurubooru (names and aliases)"""
+        with self._lock:
+            for tag in tags:
+                names = tag.get('names') or []
+                for name in names:
+                    self._known[name.lower()] = names[0]
+
+    def _is_known(self, name):
+        """Whether Szurubooru has this tag; names are kept lowercased, so "Foo_Bar" counts too (call with _lock held)"""
+        return name.lower() in self._known
+
+    def normalize(self, raw):
+        """Szurubooru name for a source tag: lowercased, underscored, aliases applied"""
+        with self._lock:
+            name = self._normalized.get(raw)
+            if name is None:
+                name = '_'.join(str(raw).strip().lower().split())
+                name = TAG_ALIASES.get(name, name)
+                self._normalized[raw] = name
+            return self._known.get(name, name)
+
+    def _missing(self, tags, categories):
+        """Normalized names to post, and the unknown ones mapped to their Szurubooru category"""
+        names = []
+        missing = {}
+        for raw in tags:
+            name = self.normalize(raw)
+            if not name or name in names:
+                continue
+            names.append(name)
+            with self._lock:
+                known = self._is_known(name)
+            if not known:
+                missing[name] = TAG_CATEGORIES.get(categories.get(raw), TAG_DEFAULT_CATEGORY)
+        return names, missing
+
+    def prepare(self, client, tags, categories=None):
+        """Normalize tags and create missing ones in their categories, returning the names to post"""
+        if self._should_warm():
+            self.warm(client)
         
-        if response.status_code == 200:
-            return response.json()
+        names, missing = self._missing(tags, categories or {})
+        if len(missing) > 1:
+            # Create all of this post's missing tags at once
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(TAG_CREATE_WORKERS, thread_name_prefix="tag-creator")
+            futures = [self._executor.submit(self._create, client, name, category)
+                       for name, category in missing.items()]
+            for future in futures:
+                future.result()
         else:
-            print(f"Post creation error: {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        print(f"Error creating post: {e}")
-        return None
+            for name, category in missing.items():
+                self._create(client, name, category)
+        return names
 
-def upload_file(filepath, metadata_path):
-    """Upload a single file to Szurubooru"""
-    filename = filepath.name
-    print(f"\n?? Uploading ({upload_stats['uploaded'] + upload_stats['failed'] + 1}/{upload_stats['total']}): {filename}")
+    def _create(self, client, name, category):
+        with self._lock:
+            if self._is_known(name):
+                return
+            pending = self._creating.get(name)
+            if pending is None:
+                pending = self._creating[name] = Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Someone else is creating this tag right now
+            pending.wait()
+            return
+        
+        try:
+            tag = client.create_tag(name, category)
+            if tag is None and category != TAG_DEFAULT_CATEGORY:
+                # The category may not exist on this instance
+                tag = client.create_tag(name, TAG_DEFAULT_CATEGORY)
+            # Even if creation failed, post creation will still create the
+            # tag itself, so never try it again
+            self.learn([tag or {"names": [name]}])
+        finally:
+            with self._lock:
+                del self._creating[name]
+            pending.set()
+
+    async def prepare_async(self, client, tags, categories=None, warm_client=None):
+        """prepare for the asyncio engine, creating missing tags concurrently on the event loop"""
+        if self._should_warm() and not self._warmed:
+            await asyncio.get_running_loop().run_in_executor(None, self.warm, warm_client or get_client())
+        
+        names, missing = self._missing(tags, categories or {})
+        await asyncio.gather(*(self._create_async(client, name, category)
+                               for name, category in missing.items()))
+        return names
+
+    async def _create_async(self, client, name, category):
+        with self._lock:
+            if self._is_known(name):
+                return
+            pending = self._creating_async.get(name)
+            owner = pending is None
+            if owner:
+                pending = self._creating_async[name] = asyncio.get_running_loop().create_future()
+        if not owner:
+            await pending
+            return
+        
+        try:
+            tag = await client.create_tag(name, category)
+            if tag is None and category != TAG_DEFAULT_CATEGORY:
+                tag = await client.create_tag(name, TAG_DEFAULT_CATEGORY)
+            self.learn([tag or {"names": [name]}])
+        finally:
+            with self._lock:
+                del self._creating_async[name]
+            pending.set_result(None)
+
+tag_cache = TagCache()
+
+PostMetadata = namedtuple('PostMetadata', ['tags', 'tag_categories', 'source', 'safety'])
+
+EMPTY_METADATA = PostMetadata([], {}, None, "safe")
+
+# Source rating -> Szurubooru safety, covering the booru letter codes and
+# the words other sites use
+SAFETY_RATINGS = {
+    "e": "unsafe", "explicit": "unsafe", "r-18": "unsafe", "r-18g": "unsafe",
+    "q": "sketchy", "questionable": "sketchy", "sensitive": "sketchy", "r-15": "sketchy",
+    "s": "safe", "safe": "safe", "g": "safe", "general": "safe",
+}
+
+# Where each gallery-dl category keeps its tags, source URL and rating.
+# Each entry lists candidate keys in order of preference.
+METADATA_FIELDS = {
+    "default": {"tags": ("tags", "tag_string"), "source": ("source", "file_url"), "rating": ("rating",)},
+    "danbooru": {"tags": ("tag_string", "tags"), "source": ("source", "file_url"), "rating": ("rating",)},
+    "e621": {"tags": ("tags",), "source": ("sources", "file_url"), "rating": ("rating",)},
+    "e926": {"tags": ("tags",), "source": ("sources", "file_url"), "rating": ("rating",)},
+    "pixiv": {"tags": ("tags",), "source": ("url",), "rating": ("rating",)},
+    "twitter": {"tags": ("hashtags",), "source": (), "rating": ()},
+}
+
+METADATA_EXTRACTORS = {}
+
+def register_metadata_extractor(*categories):
+    """Register a function turning one site's raw gallery-dl metadata into PostMetadata"""
+    def decorator(func):
+        for category in categories:
+            METADATA_EXTRACTORS[category] = func
+        return func
+    return decorator
+
+def load_json_file(path):
+    """Parse a JSON file, using orjson when it is installed"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def extract_tag_categories(metadata):
+    """Map each tag to its source category from gallery-dl's tags_<category> fields"""
+    categories = {}
+    for key, value in metadata.items():
+        if not key.startswith('tags_') or not value:
+            continue
+        category = key[len('tags_'):]
+        for tag in (value.split() if isinstance(value, str) else value):
+            categories[tag] = category
+    return categories
+
+def first_field(metadata, keys):
+    for key in keys:
+        if metadata.get(key):
+            return metadata[key]
+    return None
+
+def extract_generic_metadata(metadata):
+    """Extract post metadata using the METADATA_FIELDS mapping for the file's category"""
+    fields = METADATA_FIELDS.get(metadata.get('category'), METADATA_FIELDS["default"])
     
-    # Read metadata if available
+    # Extract tags: a space-separated string, a list, or a dict of category -> tags
     tags = []
-    source = None
-    safety = "safe"
+    tag_categories = extract_tag_categories(metadata)
+    raw_tags = first_field(metadata, fields["tags"])
+    if isinstance(raw_tags, str):
+        tags = raw_tags.split()
+    elif isinstance(raw_tags, dict):
+        for category, names in raw_tags.items():
+            for name in names or []:
+                tags.append(name)
+                tag_categories.setdefault(name, category)
+    elif isinstance(raw_tags, list):
+        tags = [tag['name'] if isinstance(tag, dict) else tag for tag in raw_tags]
     
-    if metadata_path.exists():
-        try:
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-                
-                # Extract tags
-                if 'tags' in metadata:
-                    if isinstance(metadata['tags'], list):
-                        tags = metadata['tags']
-                    elif isinstance(metadata['tags'], str):
-                        tags = metadata['tags'].split()
-                elif 'tag_string' in metadata:
-                    tags = metadata['tag_string'].split()
-                
-                # Get source URL
-                if 'source' in metadata:
-                    source = metadata['source']
-                elif 'file_url' in metadata:
-                    source = metadata['file_url']
-                
-                # Determine safety rating
-                rating = metadata.get('rating', 's')
-                if rating in ['e', 'explicit']:
-                    safety = "unsafe"
-                elif rating in ['q', 'questionable']:
-                    safety = "sketchy"
-        except Exception as e:
-            print(f"Warning: Could not read metadata: {e}")
+    # Get source URL
+    source = first_field(metadata, fields["source"])
+    if isinstance(source, list):
+        source = "\n".join(source)
     
-    # Upload file
-    token = get_file_token(filepath)
+    # Determine safety rating
+    rating = first_field(metadata, fields["rating"])
+    safety = SAFETY_RATINGS.get(str(rating).lower(), "safe") if rating else "safe"
+    
+    return PostMetadata(tags, tag_categories, source, safety)
+
+def extract_metadata(metadata):
+    """Turn a parsed gallery-dl sidecar into PostMetadata with its site's extractor"""
+    extractor = METADATA_EXTRACTORS.get(metadata.get('category'), extract_generic_metadata)
+    return extractor(metadata)
+
+def metadata_origin(metadata):
+    """The post a sidecar describes on its source site as "category:id" (plus "#num" within a gallery), or None"""
+    category, post_id = metadata.get('category'), metadata.get('id')
+    if category is None or post_id is None:
+        return None
+    num = metadata.get('num')
+    return f"{category}:{post_id}" + (f"#{num}" if num is not None else "")
+
+def read_sidecar(metadata_path):
+    """Read a metadata sidecar as (PostMetadata, origin), with empty metadata if it is missing"""
+    if not metadata_path.exists():
+        return EMPTY_METADATA, None
+    try:
+        with metrics.timer("metadata_parse"):
+            metadata = load_json_file(metadata_path)
+            return extract_metadata(metadata), metadata_origin(metadata)
+    except Exception as e:
+        print(f"Warning: Could not read metadata: {e}")
+        return EMPTY_METADATA, None
+
+class ChecksumIndex:
+    """Thread-safe cache of content checksum -> Szurubooru post id
+
+    A file reserves its checksum before the duplicate check, so when two
+    files with the same content are in flight only one is uploaded; the
+    other waits and then finds its post here.
+    """
+
+    def __init__(self):
+        self._lock = Condition()
+        self._posts = {}
+        self._reserved = {}  # Checksum -> file key uploading it
+        self._owners = {}  # File key -> reserved checksum
+
+    def get(self, checksum):
+        with self._lock:
+            return self._posts.get(checksum)
+
+    def add(self, checksum, post_id):
+        with self._lock:
+            self._posts[checksum] = post_id
+
+    def reserve(self, checksum, key, timeout=None):
+        """Claim checksum for the file key, waiting while another file holds it
+
+        Returns False if it is still held after timeout seconds (0 to just try).
+        """
+        with self._lock:
+            if not self._lock.wait_for(lambda: self._reserved.get(checksum, key) == key, timeout):
+                return False
+            self._reserved[checksum] = key
+            self._owners[key] = checksum
+            return True
+
+    def release(self, key):
+        """Give up the file's reservation once it left the pipeline, whatever the outcome"""
+        with self._lock:
+            checksum = self._owners.pop(key, None)
+            if checksum is not None:
+                del self._reserved[checksum]
+                self._lock.notify_all()
+
+checksum_index = ChecksumIndex()
+
+def file_checksum(filepath):
+    """SHA1 of the file contents, the checksum Szurubooru indexes posts by"""
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def shared_hash(job, key, compute):
+    """compute(upload_path), done once per file however many targets it goes to"""
+    if job.fanout is None:
+        return compute(job.upload_path)
+    return job.fanout.once(key, lambda: compute(job.upload_path))
+
+def known_duplicate(target, checksum):
+    """Post this or an earlier run recorded on a target for this checksum, or None
+
+    Only its id is known, which is all skipping needs; merging fetches the post.
+    """
+    post_id = target.checksums.get(checksum)
+    if post_id is None:
+        post_id = target.state().post_for_checksum(checksum)
+    return None if post_id is None else {"id": post_id}
+
+def find_duplicate(target, client, checksum):
+    """Return the target's existing post for this checksum (cache first, then server), or None"""
+    post = known_duplicate(target, checksum)
+    if post is None:
+        return client.find_post_by_checksum(checksum)
+    return client.get_post(post['id']) if DEDUP_MODE == "merge" else post
+
+async def async_find_duplicate(target, client, checksum):
+    """find_duplicate for the asyncio engine"""
+    post = known_duplicate(target, checksum)
+    if post is None:
+        return await client.find_post_by_checksum(checksum)
+    return await client.get_post(post['id']) if DEDUP_MODE == "merge" else post
+
+def merged_tags(post, tags):
+    """The post's tags plus any it is missing, or None if nothing needs adding"""
+    existing = [tag['names'][0] for tag in post.get('tags', [])]
+    missing = [tag for tag in tags if tag not in existing]
+    return existing + missing if missing else None
+
+def merge_tags(target, post, tags):
+    """Add any missing tags to an existing post, returning True on success"""
+    new_tags = merged_tags(post, tags)
+    if new_tags is None:
+        return True
+    return target.client().update_post(post['id'], post['version'], tags=new_tags) is not None
+
+class PerceptualIndex:
+    """Multi-index hash table of 64-bit perceptual hashes -> post id for fast Hamming-distance lookups
+
+    Each hash is filed under its four 16-bit chunks, one table per chunk.
+    Two hashes at most r bits apart must have a chunk that is at most
+    r // 4 bits apart, so a lookup only probes those few chunk variants
+    and compares the handful of hashes filed there. Metric trees such as
+    BK-trees end up scanning most of the index at useful radii, because
+    64-bit hashes are nearly all about 32 bits apart.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self):
+        self._lock = Lock()
+        self._posts = {}  # Hash -> post id
+        self._tables = [{} for _ in range(self.CHUNKS)]  # Chunk value -> hashes
+        self._flip_masks = {}  # Chunk radius -> masks flipping up to that many bits
+        self._loaded = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._posts)
+
+    def load(self, state_store):
+        """Add the hashes of every post recorded in the state store, once per process"""
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        for phash, post_id in state_store.perceptual_hashes():
+            self.add(phash, post_id)
+
+    def add(self, phash, post_id):
+        mask = (1 << self.CHUNK_BITS) - 1
+        with self._lock:
+            if phash in self._posts:
+                return
+            self._posts[phash] = post_id
+            for i, table in enumerate(self._tables):
+                table.setdefault((phash >> (i * self.CHUNK_BITS)) & mask, []).append(phash)
+
+    def _masks(self, radius):
+        masks = self._flip_masks.get(radius)
+        if masks is None:
+            masks = [0]
+            for flips in range(1, radius + 1):
+                for bits in itertools.combinations(range(self.CHUNK_BITS), flips):
+                    masks.append(sum(1 << bit for bit in bits))
+            self._flip_masks[radius] = masks
+        return masks
+
+    def nearest(self, phash, max_distance):
+        """(distance, post id) of the closest hash within max_distance, or None"""
+        mask = (1 << self.CHUNK_BITS) - 1
+        best = None
+        with self._lock:
+            post_id = self._posts.get(phash)
+            if post_id is not None:
+                return 0, post_id
+            flip_masks = self._masks(max_distance // self.CHUNKS)
+            compared = set()
+            for i, table in enumerate(self._tables):
+                chunk = (phash >> (i * self.CHUNK_BITS)) & mask
+                for flip in flip_masks:
+                    for candidate in table.get(chunk ^ flip, ()):
+                        if candidate in compared:
+                            continue
+                        compared.add(candidate)
+                        distance = (candidate ^ phash).bit_count()
+                        if distance <= max_distance and (best is None or distance < best[0]):
+                            best = (distance, self._posts[candidate])
+        return best
+
+perceptual_index = PerceptualIndex()
+
+class Target:
+    """A Szurubooru instance files are uploaded to
+
+    Each target has its own connection pool and rate limiter, tag and
+    duplicate caches, upload and post queues, workers, counters and state
+    table, so a slow or failing instance never holds up the others. The
+    first target uses the module-wide caches and the original state table.
+    """
+
+    def __init__(self, name, url, api_headers, primary=False, rate_limit=None,
+                 upload_workers=None, post_workers=None, queue_size=None):
+        self.name = name
+        self.url = url
+        self.headers = api_headers
+        self.rate_limit = rate_limit
+        self.upload_workers = upload_workers or UPLOAD_WORKERS
+        self.post_workers = post_workers or POST_WORKERS
+        self.key = ''.join(c if c.isalnum() else '_' for c in name.lower())
+        self.label = ""
+        self.upload_queue = FairQueue(maxsize=queue_size or UPLOAD_QUEUE_SIZE)
+        self.post_queue = FairQueue(maxsize=queue_size or UPLOAD_QUEUE_SIZE)
+        self.primary = primary
+        self.stats = upload_stats if primary else UploadStats()
+        self.tags = tag_cache if primary else TagCache()
+        self.checksums = checksum_index if primary else ChecksumIndex()
+        self.perceptual = perceptual_index if primary else PerceptualIndex()
+        self._client = None
+        self._state = None
+        self._lock = Lock()
+
+    def client(self):
+        """The target's Szurubooru client, created on first use"""
+        with self._lock:
+            if self._client is None:
+                self._client = SzuruClient(self.url, self.headers,
+                                           pool_size=SZURU_POOL_SIZE or self.upload_workers + self.post_workers,
+                                           rate_limit=self.rate_limit, stats=self.stats)
+            return self._client
+
+    def state(self):
+        """The target's upload state, opened on first use"""
+        if self.primary:
+            return get_state_store()
+        with self._lock:
+            if self._state is None:
+                self._state = StateStore(STATE_DB or ":memory:", f"files_{self.key}")
+            return self._state
+
+_targets = None
+_targets_lock = Lock()
+
+def get_targets():
+    """Return the Szurubooru instances to upload to, built from the config on first use"""
+    global _targets
+    with _targets_lock:
+        if _targets is None:
+            if not SZURU_TARGETS:
+                _targets = [Target("default", SZURU_URL, auth_headers(SZURU_USER, SZURU_TOKEN), primary=True)]
+            else:
+                # Let the fastest target run ahead instead of waiting on the slowest
+                queue_size = TARGET_BACKLOG if len(SZURU_TARGETS) > 1 else None
+                _targets = [
+                    Target(spec.get("name") or f"target{i + 1}", spec["url"],
+                           auth_headers(spec.get("user"), spec.get("token")), primary=i == 0,
+                           rate_limit=spec.get("rate_limit"), upload_workers=spec.get("upload_workers"),
+                           post_workers=spec.get("post_workers"), queue_size=queue_size)
+                    for i, spec in enumerate(SZURU_TARGETS)
+                ]
+            if len(_targets) > 1:
+                for target in _targets:
+                    target.label = f"[{target.name}] "
+                    for key in ("uploaded", "failed", "skipped"):
+                        metrics.gauge(f"{target.key}_files_{key}", lambda stats=target.stats, key=key: stats[key])
+                    metrics.gauge(f"{target.key}_upload_queue_depth", target.upload_queue.qsize)
+        return _targets
+
+def finished_everywhere(path):
+    """True once every target has the file (posted or already there)"""
+    return all(target.state().is_finished(path) for target in get_targets())
+
+def perceptual_hash(path):
+    """64-bit difference hash (dHash) of an image, or None if Pillow cannot read it"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(path) as image:
+            # Let JPEG decode at a fraction of its size, which is all we need
+            image.draft("L", (64, 64))
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    phash = 0
+    for row in range(8):
+        for col in range(8):
+            phash = (phash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return phash
+
+def check_near_duplicate(job):
+    """Hash a file and look for an uploaded look-alike, returning (phash, (distance, post id) or None)"""
+    with metrics.timer("near_dup_check"):
+        phash = shared_hash(job, "phash", perceptual_hash)
+        if phash is None:
+            return None, None
+        return phash, job.target.perceptual.nearest(phash, NEAR_DUP_DISTANCE)
+
+def apply_near_duplicate(job, phash, match, checksum):
+    """Skip a near-duplicate or mark it for a relation, per NEAR_DUP_MODE; returns None if skipped"""
+    job = job._replace(phash=phash)
+    if match is None:
+        return job
+    distance, post_id = match
+    filename = job.target.label + job.filepath.name
+    if NEAR_DUP_MODE == "skip":
+        print(f"≈ Looks like post {post_id} ({distance} bits apart), skipping: {filename}")
+        job.target.state().mark(job.filepath, "skipped", checksum=checksum, post_id=post_id, phash=phash)
+        job.target.stats.increment('skipped')
+        return None
+    print(f"≈ Looks like post {post_id} ({distance} bits apart), relating: {filename}")
+    return job._replace(relations=[post_id])
+
+def begin_upload(job):
+    """Announce a file's upload and read its metadata unless the prefetch stage already did"""
+    stats = job.target.stats.snapshot()
+    done = stats['uploaded'] + stats['failed'] + stats['skipped']
+    print(f"\n?? Uploading ({done + 1}/{stats['total']}): {job.target.label}{job.filepath.name}")
     
+    if job.metadata is None:
+        metadata, origin = read_sidecar(job.metadata_path)
+        job = job._replace(metadata=metadata, origin=origin)
+    return job
+
+def content_checksum(job):
+    """Checksum for the duplicate check, or None if the file cannot be read"""
+    try:
+        return shared_hash(job, "checksum", file_checksum)
+    except OSError as e:
+        print(f"Warning: Could not hash file: {e}")
+        return None
+
+def skip_duplicate(job, checksum, duplicate):
+    """Record a file whose content the target already has, merging its tags first in merge mode
+
+    The merge goes through the thread-based client in either engine.
+    Always returns None, as the file needs no new post.
+    """
+    target = job.target
+    filename = target.label + job.filepath.name
+    if DEDUP_MODE == "merge" and 'version' in duplicate:
+        tags, tag_categories, source, safety = job.metadata
+        tags = target.tags.prepare(target.client(), tags, tag_categories)
+        if merge_tags(target, duplicate, tags):
+            print(f"= Merged tags into existing post {duplicate['id']}: {filename}")
+        else:
+            print(f"? Failed to merge tags into post {duplicate['id']}: {filename}")
+    else:
+        print(f"= Already on server as post {duplicate['id']}, skipping: {filename}")
+    target.checksums.add(checksum, duplicate['id'])
+    target.state().mark(job.filepath, "skipped", checksum=checksum, post_id=duplicate['id'])
+    target.stats.increment('skipped')
+    return None
+
+def record_upload(job, checksum, token):
+    """Record the outcome of the content upload, returning the job for the post stage or None if it failed"""
+    target = job.target
+    state_store = target.state()
     if not token:
-        upload_stats['failed'] += 1
-        print(f"? Failed to upload: {filename}")
-        return False
+        state_store.mark(job.filepath, "failed", checksum=checksum, reason="content upload failed")
+        target.stats.increment('failed')
+        print(f"? Failed to upload: {target.label}{job.filepath.name}")
+        return None
+    
+    # Keep the token so a failed post can be retried without re-uploading
+    state_store.mark(job.filepath, "uploaded", checksum=checksum, token=token, phash=job.phash)
+    return job._replace(checksum=checksum, token=token)
+
+def upload_content(job):
+    """First upload phase: skip known duplicates, then stream the content to Szurubooru
+
+    Returns the job with its checksum and content token for the post stage,
+    or None if the file needs no new post (duplicate) or its upload failed.
+    A token left by an earlier run is used as is, without uploading again.
+    """
+    target = job.target
+    client = target.client()
+    job = begin_upload(job)
+    if job.token:
+        return job
     
-    # Create post
-    post = create_post(token, tags, safety, source)
+    # Skip content the server already has without uploading it again
+    checksum = None
+    if DEDUP_MODE != "off":
+        checksum = content_checksum(job)
+        with metrics.timer("dedup_check"):
+            if checksum:
+                # Wait for a file with the same content that is in flight
+                target.checksums.reserve(checksum, str(job.filepath))
+            duplicate = find_duplicate(target, client, checksum) if checksum else None
+        if duplicate:
+            return skip_duplicate(job, checksum, duplicate)
     
+    # Same artwork in another resolution or encoding
+    if NEAR_DUP_MODE != "off":
+        job = apply_near_duplicate(job, *check_near_duplicate(job), checksum)
+        if job is None:
+            return None
+    
+    return record_upload(job, checksum, get_file_token(job.upload_path, client))
+
+def finish_post(job, tags, post):
+    """Record the outcome of the post creation phase, returning True on success"""
+    target = job.target
+    state_store = target.state()
+    filename = target.label + job.filepath.name
     if post:
-        upload_stats['uploaded'] += 1
-        print(f" Successfully uploaded: {filename} ({len(tags)} tags)")
+        target.tags.learn(post.get('tags', []))
+        if job.checksum:
+            target.checksums.add(job.checksum, post['id'])
+        if job.phash is not None:
+            target.perceptual.add(job.phash, post['id'])
+        state_store.mark(job.filepath, "posted", post_id=post['id'], phash=job.phash, origin=job.origin)
+        target.stats.increment('uploaded')
+        print(f"✓ Successfully uploaded: {filename} ({len(tags)} tags)")
         return True
-    else:
-        upload_stats['failed'] += 1
-        print(f"? Failed to create post: {filename}")
-        return False
-
-def count_files_to_process(directory):
-    """Count how many files need to be processed"""
-    count = 0
-    if os.path.exists(directory):
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                if not filename.endswith('.json'):
-                    count += 1
-    return count
+    
+    state_store.mark(job.filepath, "failed", reason="post creation failed")
+    if job.reused_token:
+        # The token may have expired on the server; upload again next time
+        state_store.clear_token(job.filepath)
+    target.stats.increment('failed')
+    print(f"? Failed to create post: {filename}")
+    return False
 
-def monitor_and_upload():
-    """Monitor download directory and upload files as they appear"""
-    print("?? Upload monitor started")
+def publish_post(job):
+    """Second upload phase: create the post's tags, then the post from its content token"""
+    tags, tag_categories, source, safety = job.metadata
     
-    while not stop_event.is_set():
-        # Check for new files
-        if os.path.exists(DOWNLOAD_DIR):
-            for root, dirs, files in os.walk(DOWNLOAD_DIR):
-                for filename in files:
-                    # Skip metadata files
-                    if filename.endswith('.json'):
-                        continue
-                    
-                    filepath = Path(root) / filename
-                    file_key = str(filepath)
-                    
-                    # Skip if already processed or being processed
-                    if file_key in processed_files:
-                        continue
-                    
-                    # Check if file is completely downloaded (not being written to)
-                    try:
-                        # Check if file exists and is readable
-                        if not filepath.exists():
-                            continue
-                        
-                        initial_size = filepath.stat().st_size
-                        
-                        # Make sure file is not empty
-                        if initial_size == 0:
-                            continue
-                        
-                        # Wait and check if still being written
-                        time.sleep(1)
-                        
-                        if not filepath.exists():
-                            continue
-                            
-                        final_size = filepath.stat().st_size
-                        
-                        if initial_size != final_size:
-                            continue  # Still being written
-                        
-                        # Extra check: try to open the file
-                        try:
-                            with open(filepath, 'rb') as test_file:
-                                test_file.read(1)
-                        except (PermissionError, IOError):
-                            continue  # File still locked
-                            
-                    except Exception as e:
-                        print(f"Warning: Could not check file {filename}: {e}")
-                        continue
-                    
-                    # Mark as processed BEFORE uploading to prevent double-processing
-                    processed_files.add(file_key)
-                    
-                    # Upload immediately
-                    metadata_path = filepath.with_suffix(filepath.suffix + '.json')
-                    upload_file(filepath, metadata_path)
-        
-        time.sleep(0.5)  # Check twice per second
+    # Make sure every tag exists before the post references it
+    client = job.target.client()
+    with metrics.timer("tag_prepare"):
+        tags = job.target.tags.prepare(client, tags, tag_categories)
     
-    print(f"\n{'='*50}")
-    print(f"Upload complete!")
-    print(f"  Uploaded: {upload_stats['uploaded']}")
-    print(f"  Failed: {upload_stats['failed']}")
-    print(f"  Total: {upload_stats['total']}")
-    print(f"{'='*50}")
+    post = create_post(job.token, tags, safety, source, job.relations, client)
+    return finish_post(job, tags, post)
 
-def download_from_booru(url, limit=None):
-    """Download images using gallery-dl"""
-    print(f"Downloading from: {url}")
+async def async_upload_content(client, job):
+    """upload_content for the asyncio engine, running file and database work off the event loop"""
+    target = job.target
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, begin_upload, job)
+    if job.token:
+        return job
     
-    # Reset state
-    processed_files.clear()
-    stop_event.clear()
-    upload_stats['uploaded'] = 0
-    upload_stats['failed'] = 0
-    upload_stats['total'] = 0
+    checksum = None
+    if DEDUP_MODE != "off":
+        checksum = await loop.run_in_executor(None, content_checksum, job)
+        with metrics.timer("dedup_check"):
+            if checksum:
+                # Never block the event loop the other file runs on
+                while not target.checksums.reserve(checksum, str(job.filepath), timeout=0):
+                    await asyncio.sleep(0.05)
+            duplicate = await async_find_duplicate(target, client, checksum) if checksum else None
+        if duplicate:
+            return await loop.run_in_executor(None, skip_duplicate, job, checksum, duplicate)
     
-    # Setup gallery-dl config first
-    setup_gallery_dl_config()
+    if NEAR_DUP_MODE != "off":
+        job = apply_near_duplicate(job, *await loop.run_in_executor(None, check_near_duplicate, job), checksum)
+        if job is None:
+            return None
     
-    # Create download directory
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    return record_upload(job, checksum, await client.get_file_token(job.upload_path))
+
+async def async_publish_post(client, job):
+    """publish_post for the asyncio engine"""
+    tags, tag_categories, source, safety = job.metadata
     
-    # Start upload monitor in background
-    print("\n?? Starting real-time upload monitor...")
-    monitor_thread = Thread(target=monitor_and_upload, daemon=False)
-    monitor_thread.start()
+    with metrics.timer("tag_prepare"):
+        tags = await job.target.tags.prepare_async(client, tags, tag_categories, job.target.client())
     
-    # gallery-dl command
+    post = await client.create_post(job.token, tags, safety, source, job.relations)
+    return finish_post(job, tags, post)
+
+def preprocess_options():
+    """Preprocessing settings, passed explicitly because pool processes may not share our globals"""
+    return {
+        "cache_dir": os.path.abspath(PREPROCESS_CACHE_DIR),
+        "png_optimize": PNG_OPTIMIZE,
+        "gif_to_video": GIF_TO_VIDEO,
+        "max_resolution": MAX_RESOLUTION,
+    }
+
+def _optimize_png(source, target):
+    """Losslessly recompress a PNG, returning True if target was written (None if no tool is available)"""
+    for tool, args in (("oxipng", ["-o", "2", "--strip", "safe", "--out", target, source]),
+                       ("optipng", ["-quiet", "-o2", "-out", target, source])):
+        if shutil.which(tool):
+            return subprocess.run([tool, *args], stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL).returncode == 0 and os.path.exists(target)
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(source) as image:
+        image.save(target, format="PNG", optimize=True)
+    return True
+
+def _downscale_image(source, target, max_resolution):
+    """Shrink an image to fit max_resolution, returning True if target was written (None without Pillow)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(source) as image:
+        if max(image.size) <= max_resolution or getattr(image, "is_animated", False):
+            return False
+        image_format = image.format
+        image.thumbnail((max_resolution, max_resolution), Image.LANCZOS)
+        image.save(target, format=image_format, quality=95)
+    return True
+
+def _gif_to_video(source, target, container):
+    """Convert an animated GIF to MP4 or WebM with ffmpeg, returning True on success (None without ffmpeg)"""
+    if not shutil.which("ffmpeg"):
+        return None
+    if container == "webm":
+        codec = ["-c:v", "libvpx-vp9", "-b:v", "0", "-crf", "32"]
+    else:
+        codec = ["-c:v", "libx264", "-crf", "20", "-preset", "medium", "-movflags", "+faststart"]
     cmd = [
-        "gallery-dl",
-        "--write-metadata",
-        "--destination", DOWNLOAD_DIR,
-        url
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", source,
+        # Even dimensions and yuv420p keep every browser able to play it
+        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", "-pix_fmt", "yuv420p", "-an",
+        *codec, target
     ]
+    return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+def preprocess_media(path, options):
+    """Apply the preprocessing rules to one file in a pool process
+
+    Returns the path of the file to upload instead, or None to upload the
+    original. Outputs (and "nothing to do" markers) are cached under the
+    file's content hash and the rules, so each file is processed once.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    rules = []
+    if extension == ".gif" and options["gif_to_video"]:
+        rules.append(f"video:{options['gif_to_video']}")
+    elif extension in (".png", ".jpg", ".jpeg", ".webp"):
+        if options["max_resolution"]:
+            rules.append(f"max:{options['max_resolution']}")
+        if extension == ".png" and options["png_optimize"]:
+            rules.append("png")
+    if not rules:
+        return None
     
-    if limit:
-        cmd.extend(["--range", f"1-{limit}"])
+    digest = hashlib.sha1(";".join(rules).encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    key = digest.hexdigest()
+    cache_dir = options["cache_dir"]
+    os.makedirs(cache_dir, exist_ok=True)
+    output_extension = f".{options['gif_to_video']}" if rules[0].startswith("video:") else extension
+    output = os.path.join(cache_dir, key + output_extension)
+    unchanged_marker = os.path.join(cache_dir, key + ".unchanged")
+    if os.path.exists(output):
+        return output
+    if os.path.exists(unchanged_marker):
+        return None
     
+    # Work on temp names so a crash never leaves a half-written cache entry
+    current = path
+    produced = []
+    missing_tool = False
+    converted = False
     try:
-        print("\n??  Starting download...\n")
-        subprocess.run(cmd, check=True)
-        print("\n Download complete! Processing remaining files...")
-        
-        # Count total files
-        upload_stats['total'] = count_files_to_process(DOWNLOAD_DIR)
-        print(f"Found {upload_stats['total']} files to upload")
-        
-        # Process any files that were missed during download
-        print("\n?? Checking for any missed files...")
-        catch_up_count = 0
-        for root, dirs, files in os.walk(DOWNLOAD_DIR):
-            for filename in files:
-                if filename.endswith('.json'):
-                    continue
-                
-                filepath = Path(root) / filename
-                file_key = str(filepath)
-                
-                if file_key not in processed_files:
-                    processed_files.add(file_key)
-                    metadata_path = filepath.with_suffix(filepath.suffix + '.json')
-                    upload_file(filepath, metadata_path)
-                    catch_up_count += 1
-        
-        if catch_up_count > 0:
-            print(f" Processed {catch_up_count} missed files")
-        
-        # Give time for all files to be uploaded
-        print("? Waiting for all uploads to complete...")
-        last_count = 0
-        no_change_count = 0
-        
-        while True:
-            current_count = upload_stats['uploaded'] + upload_stats['failed']
-            
-            if current_count >= upload_stats['total'] and upload_stats['total'] > 0:
-                print("\n All files processed!")
-                break
-            
-            # Check if we're making progress
-            if current_count == last_count:
-                no_change_count += 1
-                if no_change_count >= 20:  # 20 seconds with no progress
-                    print(f"\n??  No progress for 20 seconds. Checking for remaining files...")
-                    remaining = upload_stats['total'] - current_count
-                    if remaining > 0:
-                        print(f"   Still {remaining} files remaining, continuing to wait...")
-                        no_change_count = 0  # Reset counter
-                    else:
-                        break
+        for rule in rules:
+            step = os.path.join(cache_dir, f"{key}.{len(produced)}.tmp{output_extension}")
+            if rule.startswith("video:"):
+                done = _gif_to_video(current, step, options["gif_to_video"])
+            elif rule.startswith("max:"):
+                done = _downscale_image(current, step, options["max_resolution"])
             else:
-                no_change_count = 0
-                last_count = current_count
-            
-            print(f"Progress: {current_count}/{upload_stats['total']} processed...", end='\r')
-            time.sleep(1)
+                done = _optimize_png(current, step)
+            if done:
+                produced.append(step)
+                current = step
+                converted = converted or rule != "png"
+            elif done is None:
+                missing_tool = True
         
-        # Stop the monitor
-        stop_event.set()
-        monitor_thread.join(timeout=5)
-        
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error downloading: {e}")
-        stop_event.set()
-        monitor_thread.join(timeout=5)
-        return False
-    except KeyboardInterrupt:
-        print("\n\n??  Interrupted by user!")
-        stop_event.set()
-        monitor_thread.join(timeout=5)
-        return False
+        # Lossless-only results are pointless unless they save space
+        changed = converted or (bool(produced) and os.path.getsize(current) < os.path.getsize(path))
+        if changed:
+            os.replace(current, output)
+            return output
+        # Only remember "nothing to do" if every rule could actually run
+        if not missing_tool:
+            open(unchanged_marker, 'w').close()
+        return None
+    finally:
+        for step in produced:
+            if os.path.exists(step):
+                os.remove(step)
 
-def main():
-    print("Booru to Szurubooru Uploader (Real-time)")
-    print("="*50)
-    
-    # Get URL from user
-    url = input("Enter booru URL (post URL, tag search, or user page): ").strip()
-    
-    # Optional: limit number of downloads
-    limit_input = input("Limit number of downloads? (press Enter for no limit, or enter a number): ").strip()
-    limit = int(limit_input) if limit_input.isdigit() else None
-    
-    # Download and upload
-    download_from_booru(url, limit)
+_preprocess_pool = None
+_preprocess_pool_lock = Lock()
 
-if __name__ == "__main__":
-    main()#!/usr/bin/env python3
-"""
-Booru to Szurubooru Uploader (Real-time upload version)
-Downloads images from booru sites using gallery-dl and uploads them to Szurubooru instantly
-"""
+def get_preprocess_pool():
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if _preprocess_pool is None:
+            # Pulls in multiprocessing, so only once preprocessing is on
+            from concurrent.futures import ProcessPoolExecutor
+            _preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+        return _preprocess_pool
 
-import json
-import os
-import subprocess
-import requests
-from pathlib import Path
-import time
-from threading import Thread, Event
-from queue import Queue
+def shutdown_preprocess_pool():
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if _preprocess_pool is not None:
+            _preprocess_pool.shutdown()
+            _preprocess_pool = None
 
-# Configuration
-SZURU_URL = "YOUR_SZURUBOORU_URL_HERE"  # e.g., "https://lboorus.lmms.wtf"
-SZURU_USER = "YOUR_SZURUBOORU_USERNAME_HERE"
-SZURU_TOKEN = "YOUR_SZURUBOORU_API_TOKEN_HERE"  # e.g., "396ec236-80b6-4232-861e-39d613db3ffc"
-DOWNLOAD_DIR = "./booru_downloads"
+def prefetch_metadata(job):
+    """Parse a file's sidecar so upload workers never wait on metadata I/O"""
+    metadata, origin = read_sidecar(job.metadata_path)
+    job = job._replace(metadata=metadata, origin=origin)
+    if PREPROCESS:
+        preprocess_queue.put(job)
+    else:
+        dispatch(job)
 
-# Rule34 API credentials
-RULE34_API_KEY = "YOUR_RULE34_API_KEY_HERE"
-RULE34_USER_ID = "YOUR_RULE34_USER_ID_HERE"
+# Preprocessed copies are keyed by content, so identical files share one;
+# copy -> jobs in flight using it
+_preprocessed_users = Counter()
+_preprocessed_users_lock = Lock()
 
-# Szurubooru API headers
-import base64
+def preprocess_queued_file(job):
+    """Run the preprocessing rules for a file on the process pool"""
+    try:
+        with metrics.timer("preprocess"):
+            output = get_preprocess_pool().submit(preprocess_media, str(job.filepath), preprocess_options()).result()
+        if output:
+            job = job._replace(upload_path=Path(output))
+            with _preprocessed_users_lock:
+                _preprocessed_users[job.upload_path] += 1
+            disk_guard.track(job.filepath, job.metadata_path, job.upload_path)
+    except Exception as e:
+        print(f"Warning: Could not preprocess {job.filepath.name}, uploading original: {e}")
+    dispatch(job)
+
+def dispatch(job):
+    """Fan a prepared file out to the upload queue of every target that does not have it yet"""
+    file_key = str(job.filepath)
+    jobs = []
+    for target in get_targets():
+        state_store = target.state()
+        if state_store.is_finished(file_key):
+            continue
+        # Content uploaded by an earlier run goes straight to post creation
+        checksum, token, phash = state_store.stored_upload(file_key)
+        jobs.append(job._replace(target=target, checksum=checksum, token=token,
+                                 reused_token=token is not None, phash=phash))
+    if not jobs:
+        finish_job(job)
+        return
+    fanout = FanOut(len(jobs))
+    for target_job in jobs:
+        target_job.target.upload_queue.put(target_job._replace(fanout=fanout, queued_at=time.monotonic()))
+
+def archive_path(path):
+    """Where RETENTION = "archive" moves a file, mirroring its place under DOWNLOAD_DIR"""
+    try:
+        relative = Path(path).resolve().relative_to(Path(DOWNLOAD_DIR).resolve())
+    except ValueError:
+        relative = Path(path).name
+    return Path(ARCHIVE_DIR) / relative
+
+def retire_file(filepath, metadata_path, upload_path=None):
+    """Delete or archive a file and its sidecar once Szurubooru has it, per RETENTION
+
+    A preprocessed copy is deleted either way; the original is what gets archived.
+    """
+    if RETENTION not in ("delete", "archive"):
+        return
+    if upload_path is not None and upload_path != filepath:
+        try:
+            upload_path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warning: Could not clean up {upload_path.name}: {e}")
+    for path in (filepath, metadata_path):
+        try:
+            if not path.exists():
+                continue
+            if RETENTION == "delete":
+                path.unlink()
+            else:
+                target = archive_path(path)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(path), str(target))
+        except OSError as e:
+            print(f"Warning: Could not clean up {path.name}: {e}")
+
+def record_crash(job, error):
+    """Count a file as failed on its target after an unexpected error in one of its stages"""
+    job.target.state().mark(job.filepath, "failed", reason=str(error))
+    job.target.stats.increment('failed')
+    print(f"Error uploading {job.target.label}{job.filepath.name}: {error!r}")
 
-auth_string = f"{SZURU_USER}:{SZURU_TOKEN}"
-auth_token = base64.b64encode(auth_string.encode()).decode('ascii')
+def release_preprocessed(job):
+    """Forget a job's preprocessed copy, returning it if no other job in flight still uploads it"""
+    if job.upload_path is None or job.upload_path == job.filepath:
+        return None
+    with _preprocessed_users_lock:
+        _preprocessed_users[job.upload_path] -= 1
+        if _preprocessed_users[job.upload_path] > 0:
+            return None
+        del _preprocessed_users[job.upload_path]
+    return job.upload_path
 
-headers = {
-    "Authorization": f"Token {auth_token}",
-    "Accept": "application/json"
-}
+def finish_job(job):
+    """Called once per file when it leaves the pipeline, whatever the outcome"""
+    finished = False
+    try:
+        upload_path = release_preprocessed(job)
+        finished = finished_everywhere(job.filepath)
+        if finished:
+            retire_file(job.filepath, job.metadata_path, upload_path)
+    finally:
+        processed_files.finish(str(job.filepath), forget=finished)
+        disk_guard.release(job.filepath)
+        disk_guard.check()
 
-# Track processed files
-processed_files = set()
-stop_event = Event()
-upload_stats = {"uploaded": 0, "failed": 0, "total": 0}
+def finish_target(job):
+    """Called once per file and target; the last target to finish lets the file leave the pipeline"""
+    job.target.checksums.release(str(job.filepath))
+    if job.fanout is None or job.fanout.done():
+        finish_job(job)
 
-def setup_gallery_dl_config():
-    """Setup gallery-dl configuration with Rule34 API credentials"""
-    config_dir = Path.home() / ".config" / "gallery-dl"
-    if os.name == 'nt':  # Windows
-        config_dir = Path(os.environ.get('APPDATA', '')) / "gallery-dl"
-    
-    config_dir.mkdir(parents=True, exist_ok=True)
-    config_file = config_dir / "config.json"
-    
-    # Create or update config
-    config = {}
-    if config_file.exists():
-        with open(config_file, 'r') as f:
-            try:
-                config = json.load(f)
-            except:
-                config = {}
-    
-    # Add Rule34 credentials
-    if "extractor" not in config:
-        config["extractor"] = {}
-    if "rule34" not in config["extractor"]:
-        config["extractor"]["rule34"] = {}
-    
-    config["extractor"]["rule34"]["api-key"] = RULE34_API_KEY
-    config["extractor"]["rule34"]["user-id"] = RULE34_USER_ID
-    
-    # Save config
-    with open(config_file, 'w') as f:
-        json.dump(config, f, indent=2)
-    
-    print(f" Gallery-dl config updated")
+def upload_queued_file(job):
+    metrics.observe("queue_wait", time.monotonic() - job.queued_at)
+    uploaded = None
+    try:
+        with metrics.timer("file_upload"):
+            uploaded = upload_content(job)
+    except Exception as e:
+        record_crash(job, e)
+    if uploaded is not None:
+        job.target.post_queue.put(uploaded._replace(queued_at=time.monotonic()))
+    else:
+        finish_target(job)
 
-def get_file_token(filepath):
-    """Upload file and get token from Szurubooru"""
+def post_queued_file(job):
+    metrics.observe("post_queue_wait", time.monotonic() - job.queued_at)
     try:
-        with open(filepath, 'rb') as f:
-            files = {'content': f}
-            response = requests.post(
-                f"{SZURU_URL}/api/uploads",
-                headers=headers,
-                files=files,
-                timeout=60
-            )
-            
-            if response.status_code == 200:
-                return response.json()['token']
-            else:
-                print(f"Upload error: {response.status_code} - {response.text}")
-                return None
+        with metrics.timer("post_publish"):
+            publish_post(job)
     except Exception as e:
-        print(f"Error uploading file: {e}")
-        return None
+        record_crash(job, e)
+    finally:
+        finish_target(job)
 
-def create_post(token, tags, safety="safe", source=None):
-    """Create a post in Szurubooru"""
+async def async_upload_queued_file(client, job):
+    metrics.observe("queue_wait", time.monotonic() - job.queued_at)
     try:
-        data = {
-            "tags": tags,
-            "safety": safety,
-            "contentToken": token
-        }
-        
-        if source:
-            data["source"] = source
-        
-        response = requests.post(
-            f"{SZURU_URL}/api/posts",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"Post creation error: {response.status_code} - {response.text}")
-            return None
+        with metrics.timer("file_upload"):
+            uploaded = await async_upload_content(client, job)
+        if uploaded is not None:
+            with metrics.timer("post_publish"):
+                await async_publish_post(client, uploaded)
     except Exception as e:
-        print(f"Error creating post: {e}")
-        return None
+        record_crash(job, e)
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, finish_target, job)
 
-def upload_file(filepath, metadata_path):
-    """Upload a single file to Szurubooru"""
-    filename = filepath.name
-    print(f"\n?? Uploading ({upload_stats['uploaded'] + upload_stats['failed'] + 1}/{upload_stats['total']}): {filename}")
+async def run_async_uploads(target):
+    """Upload files from a target's queue concurrently until a stop sentinel arrives"""
+    loop = asyncio.get_running_loop()
+    work_queue = target.upload_queue
+    # Share the thread-based client's limiter so the tag warm-up counts too
+    client = AsyncSzuruClient(target.url, target.headers, rate_limiter=target.client().rate_limiter,
+                              stats=target.stats)
+    # Only take files off the queue while there is room for them, so the
+    # queue keeps applying backpressure to discovery
+    room = asyncio.Semaphore(ASYNC_MAX_UPLOADS + ASYNC_MAX_POSTS)
+    tasks = set()
     
-    # Read metadata if available
-    tags = []
-    source = None
-    safety = "safe"
+    def finished(task):
+        tasks.discard(task)
+        room.release()
+        work_queue.task_done()
     
-    if metadata_path.exists():
+    try:
+        while True:
+            await room.acquire()
+            job = await loop.run_in_executor(None, work_queue.get)
+            if job is None:
+                work_queue.task_done()
+                break
+            task = asyncio.create_task(async_upload_queued_file(client, job))
+            tasks.add(task)
+            task.add_done_callback(finished)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await client.close()
+
+def run_async_upload_worker(target):
+    asyncio.run(run_async_uploads(target))
+
+def run_stage_worker(handle, work_queue):
+    """Handle items from a pipeline queue until a stop sentinel arrives"""
+    while True:
+        item = work_queue.get()
         try:
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-                
-                # Extract tags
-                if 'tags' in metadata:
-                    if isinstance(metadata['tags'], list):
-                        tags = metadata['tags']
-                    elif isinstance(metadata['tags'], str):
-                        tags = metadata['tags'].split()
-                elif 'tag_string' in metadata:
-                    tags = metadata['tag_string'].split()
-                
-                # Get source URL
-                if 'source' in metadata:
-                    source = metadata['source']
-                elif 'file_url' in metadata:
-                    source = metadata['file_url']
-                
-                # Determine safety rating
-                rating = metadata.get('rating', 's')
-                if rating in ['e', 'explicit']:
-                    safety = "unsafe"
-                elif rating in ['q', 'questionable']:
-                    safety = "sketchy"
-        except Exception as e:
-            print(f"Warning: Could not read metadata: {e}")
-    
-    # Upload file
-    token = get_file_token(filepath)
-    
-    if not token:
-        upload_stats['failed'] += 1
-        print(f"? Failed to upload: {filename}")
+            if item is None:
+                return
+            handle(item)
+        finally:
+            work_queue.task_done()
+
+def start_stage(name, handle, work_queue, count):
+    """Start count threads working on one pipeline stage"""
+    threads = []
+    for i in range(count):
+        thread = Thread(target=run_profiled, args=(run_stage_worker, handle, work_queue),
+                        name=f"{name}-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return work_queue, threads
+
+def start_upload_workers(count=None):
+    """Start the metadata prefetch, content upload and post creation worker pools (per target)"""
+    stages = [start_stage("metadata-worker", prefetch_metadata, metadata_queue, METADATA_WORKERS)]
+    if PREPROCESS:
+        # One thread per pool process keeps every core busy
+        processes = PREPROCESS_WORKERS or os.cpu_count() or 1
+        stages.append(start_stage("preprocess-worker", preprocess_queued_file, preprocess_queue, processes))
+    engine = ENGINE
+    if engine == "asyncio" and aiohttp is None:
+        print('Warning: ENGINE = "asyncio" needs aiohttp (pip install aiohttp), using threads')
+        engine = "threads"
+    for target in get_targets():
+        name = f"{target.key}-" if target.label else ""
+        if engine == "asyncio":
+            # One event loop handles every upload to this target
+            thread = Thread(target=run_profiled, args=(run_async_upload_worker, target),
+                            name=f"{name}upload-loop", daemon=True)
+            thread.start()
+            stages.append((target.upload_queue, [thread]))
+            print(f"?? {target.label}Started asyncio upload engine "
+                  f"({ASYNC_MAX_UPLOADS} uploads, {ASYNC_MAX_POSTS} posts in flight)")
+        else:
+            upload_workers = count or target.upload_workers
+            stages.append(start_stage(f"{name}upload-worker", upload_queued_file, target.upload_queue, upload_workers))
+            stages.append(start_stage(f"{name}post-worker", post_queued_file, target.post_queue, target.post_workers))
+            print(f"?? {target.label}Started {upload_workers} upload workers and {target.post_workers} post workers")
+    return stages
+
+def stop_upload_workers(stages, discard_pending=False):
+    """Stop the worker pools stage by stage, optionally dropping files still queued"""
+    for work_queue, threads in stages:
+        if discard_pending:
+            while True:
+                try:
+                    work_queue.get_nowait()
+                except Empty:
+                    break
+                work_queue.task_done()
+        for _ in threads:
+            work_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+def queue_upload(filepath, download_url=None):
+    """Queue a file for upload unless it has already been claimed or finished"""
+    filepath = state_key(filepath)
+    file_key = str(filepath)
+    if file_key in processed_files:
         return False
     
-    # Create post
-    post = create_post(token, tags, safety, source)
+    # Files every target got in an earlier run are never uploaded again,
+    # only cleaned up if they are still (or again) on disk
+    if finished_everywhere(file_key):
+        if RETENTION != "keep":
+            retire_file(filepath, filepath.with_suffix(filepath.suffix + '.json'))
+        return False
     
-    if post:
-        upload_stats['uploaded'] += 1
-        print(f" Successfully uploaded: {filename} ({len(tags)} tags)")
-        return True
-    else:
-        upload_stats['failed'] += 1
-        print(f"? Failed to create post: {filename}")
+    # Mark as processed BEFORE queueing to prevent double-processing
+    if not processed_files.claim(file_key):
         return False
+    new = False
+    for target in get_targets():
+        if target.state().status(file_key) is None:
+            target.state().mark(file_key, "discovered")
+            new = True
+    # Time from gallery-dl finishing the file to us queueing it. Files
+    # resumed from an earlier run would report lags of days.
+    if new:
+        try:
+            metrics.observe("discovery_lag", max(0.0, time.time() - os.stat(file_key).st_mtime))
+        except OSError:
+            pass
+    metadata_path = filepath.with_suffix(filepath.suffix + '.json')
+    disk_guard.track(filepath, metadata_path)
+    disk_guard.check()
+    metadata_queue.put(UploadJob(filepath, metadata_path, None, time.monotonic(), filepath,
+                                 download_url=download_url))
+    return True
 
-def count_files_to_process(directory):
-    """Count how many files need to be processed"""
-    count = 0
-    if os.path.exists(directory):
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                if not filename.endswith('.json'):
-                    count += 1
-    return count
+def print_upload_summary():
+    targets = get_targets()
+    print(f"\n{'='*50}")
+    print(f"Upload complete!")
+    for target in targets:
+        stats = target.stats.snapshot()
+        indent = "  "
+        if len(targets) > 1:
+            print(f"  {target.name} ({target.url}):")
+            indent = "    "
+        print(f"{indent}Uploaded: {stats['uploaded']}")
+        print(f"{indent}Failed: {stats['failed']}")
+        print(f"{indent}Skipped (duplicates): {stats['skipped']}")
+        print(f"{indent}Retried requests: {stats['retries']}")
+        print(f"{indent}Total: {stats['total']}")
+    print(f"{'='*50}")
+
+def set_upload_total(total):
+    """Set the file count every target's progress is reported against"""
+    for target in get_targets():
+        target.stats['total'] = total
+
+def resume_pending_uploads():
+    """Queue files an earlier run discovered but never finished"""
+    resumed = 0
+    pending = itertools.chain.from_iterable(target.state().pending() for target in get_targets())
+    for path in dict.fromkeys(pending):
+        filepath = Path(path)
+        if filepath.exists() and queue_upload(filepath):
+            resumed += 1
+    if resumed:
+        print(f"?? Resuming {resumed} unfinished uploads from the last run")
+    return resumed
+
+def is_upload_candidate(filename):
+    """Return True for finished media files, skipping sidecars and partial downloads"""
+    return not (filename.endswith('.json') or filename.endswith('.part') or filename.startswith('.'))
+
+def is_sidecar(filename):
+    return filename.endswith('.json') and not filename.startswith('.')
+
+class SidecarPairs:
+    """Holds back media files found before their .json sidecar until it lands
+
+    Discovery reports media files and sidecars as they complete, in either
+    order. A media file is queued as soon as both halves are there, or once
+    SIDECAR_GRACE seconds pass without its sidecar. Every report is a
+    couple of dict/set operations; deadlines are kept in arrival order, so
+    expiring them only ever looks at the oldest.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._waiting = {}  # media path -> (Path, download URL), for media without a sidecar yet
+        self._sidecars = set()  # media paths whose sidecar is complete
+        self._deadlines = deque()  # (deadline, media path) in arrival order
+
+    def media_ready(self, filepath, sidecar_on_disk=False, download_url=None):
+        """Note a complete media file, queueing it if its sidecar is there
+
+        sidecar_on_disk trusts a sidecar that exists without having been
+        reported, as gallery-dl writes it before printing the file's path.
+        """
+        key = str(filepath)
+        with self._lock:
+            if key in self._waiting:
+                return
+            paired = key in self._sidecars
+            if not paired and not (sidecar_on_disk and os.path.exists(key + '.json')):
+                self._waiting[key] = (filepath, download_url)
+                self._deadlines.append((time.monotonic() + SIDECAR_GRACE, key))
+                return
+            self._sidecars.discard(key)
+        queue_upload(filepath, download_url)
+
+    def sidecar_ready(self, metadata_path):
+        """Note a complete sidecar, queueing its media file if that was waiting for it"""
+        key = str(metadata_path)[:-len('.json')]
+        with self._lock:
+            waiting = self._waiting.pop(key, None)
+            if waiting is None:
+                self._sidecars.add(key)
+                return
+        queue_upload(*waiting)
+
+    def _take(self, expired_only):
+        now = time.monotonic()
+        taken = []
+        with self._lock:
+            while self._deadlines and (not expired_only or self._deadlines[0][0] <= now):
+                _, key = self._deadlines.popleft()
+                waiting = self._waiting.pop(key, None)
+                if waiting is not None:
+                    taken.append(waiting)
+        return taken
+
+    def _release(self, waiting):
+        for filepath, download_url in waiting:
+            if not filepath.with_suffix(filepath.suffix + '.json').exists():
+                print(f"Warning: No metadata for {filepath.name}, uploading without it")
+            queue_upload(filepath, download_url)
+
+    def expire(self):
+        """Queue media files whose grace period ran out, with whatever metadata exists by now"""
+        self._release(self._take(expired_only=True))
+
+    def flush(self):
+        """Queue every waiting media file now, e.g. once gallery-dl has exited"""
+        self._release(self._take(expired_only=False))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._waiting)
+
+    def clear(self):
+        with self._lock:
+            self._waiting.clear()
+            self._sidecars.clear()
+            self._deadlines.clear()
+
+sidecar_pairs = SidecarPairs()
+
+def expire_sidecar_waits():
+    """Release media files whose sidecar never arrived, until the pipeline stops"""
+    while not stop_event.wait(min(POLL_INTERVAL, SIDECAR_GRACE)):
+        sidecar_pairs.expire()
 
 def monitor_and_upload():
-    """Monitor download directory and upload files as they appear"""
-    print("?? Upload monitor started")
+    """Poll the download directory and queue files once their size settles"""
+    print("?? Upload monitor started (polling)")
+    
+    # Size and mtime of not-yet-queued files as of the previous scan
+    last_seen = {}
     
     while not stop_event.is_set():
         # Check for new files
         if os.path.exists(DOWNLOAD_DIR):
-            for root, dirs, files in os.walk(DOWNLOAD_DIR):
+            seen = {}
+            # Canonical paths, as processed_files holds them
+            for root, dirs, files in os.walk(os.path.realpath(DOWNLOAD_DIR)):
                 for filename in files:
-                    # Skip metadata files
-                    if filename.endswith('.json'):
+                    # Skip partial downloads
+                    sidecar = is_sidecar(filename)
+                    if not (sidecar or is_upload_candidate(filename)):
                         continue
                     
                     filepath = Path(root) / filename
                     file_key = str(filepath)
                     
-                    # Skip if already processed or being processed
-                    if file_key in processed_files:
+                    # Skip if already processed or being processed (for a
+                    # sidecar: its media file)
+                    if (file_key[:-len('.json')] if sidecar else file_key) in processed_files:
                         continue
                     
-                    # Check if file is completely downloaded (not being written to)
                     try:
-                        # Check if file exists and is readable
-                        if not filepath.exists():
-                            continue
-                        
-                        initial_size = filepath.stat().st_size
-                        
-                        # Make sure file is not empty
-                        if initial_size == 0:
-                            continue
-                        
-                        # Wait and check if still being written
-                        time.sleep(1)
-                        
-                        if not filepath.exists():
-                            continue
-                            
-                        final_size = filepath.stat().st_size
-                        
-                        if initial_size != final_size:
-                            continue  # Still being written
-                        
-                        # Extra check: try to open the file
-                        try:
-                            with open(filepath, 'rb') as test_file:
-                                test_file.read(1)
-                        except (PermissionError, IOError):
-                            continue  # File still locked
-                            
-                    except Exception as e:
-                        print(f"Warning: Could not check file {filename}: {e}")
+                        stat = os.stat(file_key)
+                    except OSError:
+                        continue
+                    
+                    # Make sure file is not empty
+                    if stat.st_size == 0:
                         continue
                     
-                    # Mark as processed BEFORE uploading to prevent double-processing
-                    processed_files.add(file_key)
+                    # A file that did not change for a whole poll interval is
+                    # finished; otherwise check it again on the next scan
+                    signature = (stat.st_size, stat.st_mtime_ns)
+                    if last_seen.get(file_key) != signature:
+                        seen[file_key] = signature
+                        continue
+                    
+                    # Extra check: try to open the file
+                    try:
+                        with open(filepath, 'rb') as test_file:
+                            test_file.read(1)
+                    except (PermissionError, IOError):
+                        seen[file_key] = signature
+                        continue  # File still locked
                     
-                    # Upload immediately
-                    metadata_path = filepath.with_suffix(filepath.suffix + '.json')
-                    upload_file(filepath, metadata_path)
+                    # Hand off to the upload workers once both halves are in
+                    if sidecar:
+                        sidecar_pairs.sidecar_ready(filepath)
+                    else:
+                        sidecar_pairs.media_ready(filepath)
+            last_seen = seen
         
-        time.sleep(0.5)  # Check twice per second
+        stop_event.wait(POLL_INTERVAL)
     
-    print(f"\n{'='*50}")
-    print(f"Upload complete!")
-    print(f"  Uploaded: {upload_stats['uploaded']}")
-    print(f"  Failed: {upload_stats['failed']}")
-    print(f"  Total: {upload_stats['total']}")
-    print(f"{'='*50}")
+    print("?? Upload monitor stopped")
 
-def download_from_booru(url, limit=None):
-    """Download images using gallery-dl"""
-    print(f"Downloading from: {url}")
+class Inotify:
+    """Minimal ctypes binding to Linux inotify that watches a whole directory tree"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        self._watches = {}
+
+    def add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), self.WATCH_MASK)
+        if wd < 0:
+            errno = self._ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch failed for {directory}: {os.strerror(errno)}")
+        self._watches[wd] = Path(directory)
+
+    def add_tree(self, directory):
+        """Watch a directory and all its subdirectories, returning the files already in them"""
+        existing = []
+        for root, dirs, files in os.walk(directory):
+            try:
+                self.add_watch(root)
+            except OSError as e:
+                print(f"Warning: Could not watch {root}: {e}")
+                continue
+            existing.extend(Path(root) / filename for filename in files)
+        return existing
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds and return a list of (path, mask) events"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif wd in self._watches and name:
+                events.append((self._watches[wd] / os.fsdecode(name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def queue_if_finished(filepath, sidecar_on_disk=False, download_url=None):
+    """Pass a complete media file or sidecar found by discovery on to be paired and queued"""
+    filepath = state_key(filepath)
+    if is_sidecar(filepath.name):
+        sidecar_pairs.sidecar_ready(filepath)
+        return
+    if not is_upload_candidate(filepath.name):
+        return
+    try:
+        if filepath.stat().st_size == 0:
+            return
+    except OSError:
+        return
+    sidecar_pairs.media_ready(filepath, sidecar_on_disk, download_url)
+
+def watch_with_inotify(inotify):
+    """Queue files the moment gallery-dl closes or renames them into place"""
+    print("?? Upload monitor started (inotify)")
     
-    # Reset state
-    processed_files.clear()
-    stop_event.clear()
-    upload_stats['uploaded'] = 0
-    upload_stats['failed'] = 0
-    upload_stats['total'] = 0
+    try:
+        for filepath in inotify.add_tree(DOWNLOAD_DIR):
+            queue_if_finished(filepath)
+        
+        while not stop_event.is_set():
+            for path, mask in inotify.read_events(POLL_INTERVAL):
+                if path is None:
+                    # Kernel queue overflowed and events were lost, rescan once
+                    print("Warning: inotify queue overflowed, rescanning downloads")
+                    for filepath in inotify.add_tree(DOWNLOAD_DIR):
+                        queue_if_finished(filepath)
+                elif mask & Inotify.IN_ISDIR:
+                    # New subdirectory: watch it and pick up anything that
+                    # landed in it before the watch existed
+                    for filepath in inotify.add_tree(path):
+                        queue_if_finished(filepath)
+                elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    queue_if_finished(path)
+    finally:
+        inotify.close()
     
-    # Setup gallery-dl config first
-    setup_gallery_dl_config()
+    print("?? Upload monitor stopped")
+
+def stream_downloads(process, on_file=None, download_url=None):
+    """Queue files as gallery-dl reports them on stdout, echoing its output
+
+    on_file is called with the path of every file gallery-dl reports and
+    whether it was skipped as downloaded before, ahead of queueing it (and
+    so before RETENTION can remove it). Files are scheduled under
+    download_url, the URL gallery-dl is fetching.
+    """
+    for raw_line in process.stdout:
+        line = os.fsdecode(raw_line.rstrip(b"\r\n"))
+        if not line:
+            continue
+        print(line)
+        
+        # gallery-dl prints the path of every finished file, prefixed with
+        # "# " when it was already downloaded by an earlier run. Queueing
+        # blocks while the upload queue is full, which stops us reading and
+        # in turn pauses gallery-dl until the workers catch up.
+        skipped = line.startswith("# ")
+        path = Path(line[2:] if skipped else line)
+        if on_file is not None:
+            on_file(path, skipped)
+        queue_if_finished(path, sidecar_on_disk=True, download_url=download_url)
+
+def start_discovery(backend=None):
+    """Start a directory watcher thread in addition to gallery-dl's stdout, if configured"""
+    backend = backend or DISCOVERY_BACKEND
     
-    # Create download directory
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    if backend in ("auto", "stdout"):
+        return None
     
-    # Start upload monitor in background
-    print("\n?? Starting real-time upload monitor...")
-    monitor_thread = Thread(target=monitor_and_upload, daemon=False)
-    monitor_thread.start()
+    if backend == "inotify" and sys.platform.startswith("linux"):
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            print(f"Warning: inotify unavailable ({e}), falling back to polling")
+        else:
+            thread = Thread(target=watch_with_inotify, args=(inotify,), name="discovery", daemon=True)
+            thread.start()
+            return thread
     
-    # gallery-dl command
+    thread = Thread(target=monitor_and_upload, name="discovery", daemon=True)
+    thread.start()
+    return thread
+
+def run_gallery_dl(url, limit=None, extra_args=(), on_file=None):
+    """Run one gallery-dl extraction, queueing files for upload as they finish"""
     cmd = [
         "gallery-dl",
         "--write-metadata",
         "--destination", DOWNLOAD_DIR,
-        url
     ]
+    if RETENTION != "keep" and DOWNLOAD_ARCHIVE and "--download-archive" not in extra_args:
+        cmd.extend(["--download-archive", DOWNLOAD_ARCHIVE])
+    cmd.extend(extra_args)
+    cmd.append(url)
     
     if limit:
         cmd.extend(["--range", f"1-{limit}"])
     
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    disk_guard.register(process)
     try:
-        print("\n??  Starting download...\n")
-        subprocess.run(cmd, check=True)
-        print("\n Download complete! Processing remaining files...")
-        
-        # Count total files
-        upload_stats['total'] = count_files_to_process(DOWNLOAD_DIR)
-        print(f"Found {upload_stats['total']} files to upload")
-        
-        # Process any files that were missed during download
-        print("\n?? Checking for any missed files...")
-        catch_up_count = 0
-        for root, dirs, files in os.walk(DOWNLOAD_DIR):
-            for filename in files:
-                if filename.endswith('.json'):
-                    continue
-                
-                filepath = Path(root) / filename
-                file_key = str(filepath)
-                
-                if file_key not in processed_files:
-                    processed_files.add(file_key)
-                    metadata_path = filepath.with_suffix(filepath.suffix + '.json')
-                    upload_file(filepath, metadata_path)
-                    catch_up_count += 1
-        
-        if catch_up_count > 0:
-            print(f" Processed {catch_up_count} missed files")
-        
-        # Give time for all files to be uploaded
-        print("? Waiting for all uploads to complete...")
-        last_count = 0
-        no_change_count = 0
+        stream_downloads(process, on_file, url)
+    finally:
+        disk_guard.unregister(process)
+        if process.poll() is None:
+            process.terminate()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def start_pipeline(discover=True, warm_tags=None):
+    """Reset state and start the shared upload workers and file discovery
+
+    With discover=False only files the caller queues are uploaded: nothing
+    is resumed from earlier runs and DOWNLOAD_DIR is not watched.
+    warm_tags overrides TAG_CACHE_WARM for this pipeline only.
+    """
+    processed_files.clear()
+    sidecar_pairs.clear()
+    stop_event.clear()
+    for target in get_targets():
+        target.stats.reset()
+        target.tags.warm_tags = warm_tags
+    disk_guard.reset()
+    
+    if discover:
+        # Setup gallery-dl config first
+        setup_gallery_dl_config()
         
-        while True:
-            current_count = upload_stats['uploaded'] + upload_stats['failed']
-            
-            if current_count >= upload_stats['total'] and upload_stats['total'] > 0:
-                print("\n All files processed!")
-                break
-            
-            # Check if we're making progress
-            if current_count == last_count:
-                no_change_count += 1
-                if no_change_count >= 20:  # 20 seconds with no progress
-                    print(f"\n??  No progress for 20 seconds. Checking for remaining files...")
-                    remaining = upload_stats['total'] - current_count
-                    if remaining > 0:
-                        print(f"   Still {remaining} files remaining, continuing to wait...")
-                        no_change_count = 0  # Reset counter
-                    else:
-                        break
-            else:
-                no_change_count = 0
-                last_count = current_count
-            
-            print(f"Progress: {current_count}/{upload_stats['total']} processed...", end='\r')
-            time.sleep(1)
+        # Create download directory
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    
+    start_metrics_exporters()
+    
+    if NEAR_DUP_MODE != "off":
+        if importlib.util.find_spec("PIL") is None:
+            print(f'Warning: NEAR_DUP_MODE = "{NEAR_DUP_MODE}" needs Pillow (pip install Pillow), near-duplicates will not be detected')
+        else:
+            for target in get_targets():
+                target.perceptual.load(target.state())
+    
+    # Start upload workers and monitor in background
+    print("\n?? Starting real-time upload monitor...")
+    workers = start_upload_workers()
+    Thread(target=expire_sidecar_waits, name="sidecar-pairs", daemon=True).start()
+    if not discover:
+        return workers, None
+    resume_pending_uploads()
+    monitor_thread = start_discovery()
+    return workers, monitor_thread
+
+def wait_for_uploads():
+    """Wait until every queued file has been uploaded, skipped or has failed"""
+    # Everything gallery-dl reported has been queued by now, and it has
+    # written every sidecar it was going to
+    sidecar_pairs.flush()
+    total = processed_files.claimed
+    set_upload_total(total)
+    print(f"Found {total} files to upload")
+    
+    # Every claimed file leaves the pipeline exactly once, so this returns
+    # the moment the last one is done
+    print("? Waiting for all uploads to complete...")
+    while not processed_files.wait_idle(timeout=1.0):
+        current_count = total - processed_files.in_flight
+        print(f"Progress: {current_count}/{total} processed...", end='\r')
+    print("\n✓ All files processed!")
+
+def stop_pipeline(workers, monitor_thread, discard_pending=False):
+    """Stop the monitor, then let the workers drain the queue and report"""
+    stop_event.set()
+    if monitor_thread:
+        # Discovery checks stop_event at least every POLL_INTERVAL
+        monitor_thread.join()
+    stop_upload_workers(workers, discard_pending=discard_pending)
+    shutdown_preprocess_pool()
+    print_upload_summary()
+    write_profile()
+
+def download_batch(urls, limit=None, concurrency=None):
+    """Download several URLs with concurrent gallery-dl runs feeding one upload pool
+
+    Lines may carry "priority=N" and "weight=N" after the URL. Higher
+    priority URLs are downloaded first and their files jump the upload
+    queues; see FairQueue.
+    """
+    urls = [split_url_line(url)[0] for url in urls]
+    concurrency = max(1, min(concurrency or DOWNLOAD_WORKERS, len(urls)))
+    workers, monitor_thread = start_pipeline()
+    
+    url_queue = Queue()
+    for url in sorted(urls, key=lambda url: -source_priorities.get(url, (0, 1))[0]):
+        url_queue.put(url)
+    failed_urls = []
+    
+    def download_worker():
+        while not stop_event.is_set():
+            try:
+                url = url_queue.get_nowait()
+            except Empty:
+                return
+            print(f"Downloading from: {url}")
+            try:
+                run_gallery_dl(url, limit)
+                print(f"\n✓ Download complete: {url}")
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f"Error downloading {url}: {e}")
+                failed_urls.append(url)
+    
+    try:
+        print(f"\n??  Starting download of {len(urls)} URLs ({concurrency} at a time)...\n")
+        downloaders = [
+            Thread(target=download_worker, name=f"download-worker-{i}", daemon=True)
+            for i in range(concurrency)
+        ]
+        for downloader in downloaders:
+            downloader.start()
+        for downloader in downloaders:
+            downloader.join()
         
-        # Stop the monitor
-        stop_event.set()
-        monitor_thread.join(timeout=5)
+        wait_for_uploads()
+        stop_pipeline(workers, monitor_thread)
+        if failed_urls:
+            print(f"{len(failed_urls)} of {len(urls)} downloads failed:")
+            for url in failed_urls:
+                print(f"  {url}")
+        return not failed_urls
+    except KeyboardInterrupt:
+        print("\n\n??  Interrupted by user!")
+        stop_pipeline(workers, monitor_thread, discard_pending=True)
+        return False
+
+def download_from_booru(url, limit=None):
+    """Download images using gallery-dl"""
+    print(f"Downloading from: {url}")
+    
+    workers, monitor_thread = start_pipeline()
+    
+    try:
+        print("\n??  Starting download...\n")
+        run_gallery_dl(url, limit)
+        print("\n✓ Download complete! Processing remaining files...")
         
+        wait_for_uploads()
+        stop_pipeline(workers, monitor_thread)
         return True
     except subprocess.CalledProcessError as e:
         print(f"Error downloading: {e}")
-        stop_event.set()
-        monitor_thread.join(timeout=5)
+        stop_pipeline(workers, monitor_thread)
         return False
     except KeyboardInterrupt:
         print("\n\n??  Interrupted by user!")
-        stop_event.set()
-        monitor_thread.join(timeout=5)
+        stop_pipeline(workers, monitor_thread, discard_pending=True)
         return False
 
-def main():
+def upload_files(paths, warm_tags=False):
+    """Upload files that are already on disk, e.g. handed over one post at a time by a gallery-dl exec hook
+
+    Files every target already has are skipped before anything is started,
+    so a repeated call costs little more than a state lookup. By default
+    the tag cache is not warmed: paging through every tag on the server
+    would dwarf one post, so only the post's own tags are created (existing
+    ones just answer "already exists"). warm_tags=None follows TAG_CACHE_WARM.
+    """
+    pending = []
+    for filepath in map(Path, paths):
+        if not filepath.is_file():
+            print(f"Warning: {filepath} does not exist")
+        elif is_upload_candidate(filepath.name) and not finished_everywhere(filepath):
+            pending.append(filepath)
+    if not pending:
+        print("Nothing to upload")
+        return True
+    
+    workers, monitor_thread = start_pipeline(discover=False, warm_tags=warm_tags)
+    try:
+        for filepath in pending:
+            queue_upload(filepath)
+        wait_for_uploads()
+        stop_pipeline(workers, monitor_thread)
+        return all(target.stats['failed'] == 0 for target in get_targets())
+    except KeyboardInterrupt:
+        print("\n\n??  Interrupted by user!")
+        stop_pipeline(workers, monitor_thread, discard_pending=True)
+        return False
+
+def source_post_id(filepath):
+    """Numeric source post id of a downloaded file, or None
+
+    Read from its gallery-dl sidecar, or from the origin kept in STATE_DB
+    once RETENTION has removed the sidecar.
+    """
+    try:
+        return int(load_json_file(filepath.with_suffix(filepath.suffix + '.json'))['id'])
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    origin = get_state_store().origin(filepath)
+    try:
+        return int(origin.split(':', 1)[1].split('#', 1)[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def poll_subscription(url, limit=None):
+    """Fetch a saved search's posts newer than its high-water id, returning how many were new
+
+    gallery-dl's download archive skips posts fetched before, and because
+    searches list the newest posts first, the filter stops paging at the
+    first post at or below the high-water id. A poll therefore only costs
+    as much as the new content. The high-water id only moves after a
+    successful run, so posts missed by a failed poll are fetched next time.
+    Posts gallery-dl skips count towards it too, so a search mirrored
+    before (by --batch, or a poll cut short) gets its high-water id on the
+    first complete poll instead of being paged through again every time.
+    """
+    state_store = get_state_store()
+    high_water = state_store.high_water(url)
+    extra_args = ["--download-archive", DOWNLOAD_ARCHIVE] if DOWNLOAD_ARCHIVE else []
+    if high_water is not None:
+        extra_args += ["--filter", f"id > {high_water} or abort()"]
+    
+    new_ids = []
+    seen_ids = []
+    
+    def record_post(filepath, skipped):
+        post_id = source_post_id(filepath)
+        if post_id is not None:
+            seen_ids.append(post_id)
+            if not skipped:
+                new_ids.append(post_id)
+    
+    print(f"?? Checking {url}" + (f" for posts after {high_water}" if high_water is not None else ""))
+    run_gallery_dl(url, limit, extra_args, on_file=record_post)
+    state_store.set_high_water(url, max(seen_ids, default=high_water))
+    return len(new_ids)
+
+def read_subscriptions(source):
+    """Read saved searches as (url, interval) pairs from lines of "URL [seconds] [priority=N] [weight=N]" """
+    subscriptions = []
+    for line in read_url_list(source):
+        url, fields = split_url_line(line)
+        if fields and fields[0].isdigit():
+            subscriptions.append((url, int(fields[0])))
+        else:
+            subscriptions.append((url, SUBSCRIPTION_INTERVAL))
+    return subscriptions
+
+def run_subscriptions(subscriptions, limit=None, concurrency=None):
+    """Poll saved searches on their own schedules until interrupted, uploading new posts as they arrive"""
+    concurrency = max(1, min(concurrency or DOWNLOAD_WORKERS, len(subscriptions)))
+    workers, monitor_thread = start_pipeline()
+    pollers = ThreadPoolExecutor(concurrency, thread_name_prefix="subscription")
+    next_poll = {url: 0.0 for url, _ in subscriptions}
+    running = {}
+    
+    print(f"\n?? Watching {len(subscriptions)} saved searches ({concurrency} polled at a time)...\n")
+    try:
+        while not stop_event.is_set():
+            now = time.monotonic()
+            for url, interval in subscriptions:
+                future = running.get(url)
+                if future is None and now >= next_poll[url]:
+                    running[url] = pollers.submit(poll_subscription, url, limit)
+                elif future is not None and future.done():
+                    del running[url]
+                    next_poll[url] = now + interval
+                    try:
+                        print(f"\n✓ {url}: {future.result()} new posts, next check in {interval}s")
+                    except (subprocess.CalledProcessError, OSError) as e:
+                        print(f"Error checking {url}: {e}")
+            set_upload_total(processed_files.claimed)
+            stop_event.wait(1.0)
+        pollers.shutdown()
+        stop_pipeline(workers, monitor_thread)
+        return True
+    except KeyboardInterrupt:
+        print("\n\n??  Interrupted by user!")
+        stop_event.set()
+        pollers.shutdown(wait=False, cancel_futures=True)
+        stop_pipeline(workers, monitor_thread, discard_pending=True)
+        return True
+
+def fetch_metadata(url, destination, limit=None):
+    """Write the current metadata sidecars of a URL's posts under destination, downloading no media"""
+    cmd = ["gallery-dl", "--no-download", "--write-metadata", "--destination", str(destination), url]
+    if limit:
+        cmd.extend(["--range", f"1-{limit}"])
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+
+def iter_sidecars(directory):
+    """(origin, PostMetadata) of every readable sidecar under directory that names its source post"""
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if not is_sidecar(filename):
+                continue
+            metadata, origin = read_sidecar(Path(root) / filename)
+            if origin is not None and metadata is not EMPTY_METADATA:
+                yield origin, metadata
+
+def backfill_origins(target):
+    """Record the origin of posts uploaded before origins were kept, from sidecars still on disk"""
+    state_store = target.state()
+    recovered = 0
+    for path in state_store.posted_without_origin():
+        metadata_path = Path(path + '.json')
+        if metadata_path.exists():
+            _, origin = read_sidecar(metadata_path)
+            if origin is not None:
+                state_store.set_origin(path, origin)
+                recovered += 1
+    if recovered:
+        print(f"?? {target.label}Recovered the source post of {recovered} earlier uploads")
+
+def post_changes(target, post, metadata):
+    """Fields of a Szurubooru post that differ from its source's metadata, creating any new tags"""
+    changes = {}
+    tags = target.tags.prepare(target.client(), metadata.tags, metadata.tag_categories)
+    if SYNC_REMOVE_TAGS:
+        if set(tags) != {tag['names'][0] for tag in post.get('tags', [])}:
+            changes['tags'] = tags
+    else:
+        new_tags = merged_tags(post, tags)
+        if new_tags is not None:
+            changes['tags'] = new_tags
+    if metadata.safety != post.get('safety'):
+        changes['safety'] = metadata.safety
+    return changes
+
+def sync_batch(target, batch, counts):
+    """Compare a batch of (origin, metadata) with the target's posts, updating only what changed"""
+    client = target.client()
+    try:
+        posts_by_origin = target.state().posts_for_origins(origin for origin, _ in batch)
+        counts.increment('unknown', sum(origin not in posts_by_origin for origin, _ in batch))
+        if not posts_by_origin:
+            return
+        # One search fetches the whole batch
+        posts = client.get_posts(sorted(set(posts_by_origin.values())))
+        if posts is None:
+            counts.increment('failed', len(posts_by_origin))
+            return
+        for origin, metadata in batch:
+            post_id = posts_by_origin.get(origin)
+            if post_id is None:
+                continue
+            post = posts.get(post_id)
+            if post is None:
+                counts.increment('missing')
+                continue
+            changes = post_changes(target, post, metadata)
+            if not changes:
+                counts.increment('unchanged')
+                continue
+            updated = client.update_post(post_id, post['version'], **changes)
+            if updated:
+                target.tags.learn(updated.get('tags', []))
+                counts.increment('updated')
+                print(f"✓ {target.label}Updated {', '.join(changes)} of post {post_id} from {origin}")
+            else:
+                counts.increment('failed')
+                print(f"? {target.label}Failed to update post {post_id} from {origin}")
+    except Exception as e:
+        counts.increment('failed', len(batch))
+        print(f"Error syncing {target.label}batch: {e!r}")
+
+def sync_metadata(urls, limit=None):
+    """Refresh tags and safety of posts mirrored from these URLs, without downloading any media
+
+    gallery-dl only writes the posts' current metadata. Each sidecar is
+    matched to its Szurubooru post through the origin recorded at upload,
+    posts are fetched SYNC_BATCH_SIZE at a time, and only fields that
+    changed are sent back, SYNC_WORKERS batches at once.
+    """
+    setup_gallery_dl_config()
+    targets = get_targets()
+    for target in targets:
+        backfill_origins(target)
+    counts = UploadStats(("updated", "unchanged", "unknown", "missing", "failed"))
+    failed_urls = []
+    
+    with ThreadPoolExecutor(SYNC_WORKERS, thread_name_prefix="sync") as executor:
+        for url in urls:
+            workdir = tempfile.mkdtemp(prefix="giggleupload-sync-")
+            try:
+                print(f"?? Fetching current metadata for {url}")
+                try:
+                    fetch_metadata(url, workdir, limit)
+                except (subprocess.CalledProcessError, OSError) as e:
+                    # Still sync whatever was fetched before the error
+                    print(f"Error fetching metadata for {url}: {e}")
+                    failed_urls.append(url)
+                
+                sidecars = iter_sidecars(workdir)
+                pending = set()
+                while True:
+                    batch = list(itertools.islice(sidecars, SYNC_BATCH_SIZE))
+                    if not batch:
+                        break
+                    for target in targets:
+                        pending.add(executor.submit(sync_batch, target, batch, counts))
+                    # Keep only a few batches parsed ahead of the workers
+                    if len(pending) >= SYNC_WORKERS * 2:
+                        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                wait(pending)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    
+    stats = counts.snapshot()
+    print(f"\n{'='*50}")
+    print(f"Sync complete!")
+    print(f"  Updated: {stats['updated']}")
+    print(f"  Unchanged: {stats['unchanged']}")
+    print(f"  Not mirrored: {stats['unknown']}")
+    print(f"  Deleted from Szurubooru: {stats['missing']}")
+    print(f"  Failed: {stats['failed']}")
+    print(f"{'='*50}")
+    if failed_urls:
+        print(f"Metadata could not be fetched completely for {len(failed_urls)} URLs:")
+        for url in failed_urls:
+            print(f"  {url}")
+    return not failed_urls and stats['failed'] == 0
+
+def split_url_line(line):
+    """Split a URL list line into the URL and its other fields, recording "priority=N" and "weight=N" for scheduling"""
+    url, *fields = line.split()
+    priority, weight = source_priorities.get(url, (0, 1))
+    rest = []
+    for field in fields:
+        key, _, value = field.partition('=')
+        try:
+            if key == "priority":
+                priority = int(value)
+            elif key == "weight":
+                weight = float(value)
+            else:
+                rest.append(field)
+        except ValueError:
+            print(f"Warning: Ignoring invalid {key} for {url}: {value!r}")
+    if (priority, weight) != (0, 1):
+        source_priorities[url] = (priority, weight)
+    return url, rest
+
+def read_url_list(source):
+    """Read URLs from a file (or stdin for "-"), one per line, ignoring blanks and # comments"""
+    if source == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download from booru sites with gallery-dl and upload to Szurubooru")
+    parser.add_argument("url", nargs="?",
+                        help="post URL, tag search or user page to download (asked for when omitted on a terminal)")
+    parser.add_argument("--config", metavar="FILE", default=os.environ.get(CONFIG_ENV_PREFIX + "CONFIG"),
+                        help="JSON file of settings overriding the ones in this script "
+                             f"(default ${CONFIG_ENV_PREFIX}CONFIG); {CONFIG_ENV_PREFIX}<NAME> "
+                             "environment variables override both")
+    parser.add_argument("--upload", metavar="FILE", nargs="+",
+                        help="upload these files (and their .json sidecars) that are already on disk, "
+                             "e.g. from a gallery-dl exec post-processor")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="read URLs from FILE (\"-\" for stdin) instead of asking interactively")
+    parser.add_argument("--subscribe", metavar="FILE",
+                        help="keep polling the saved searches in FILE (\"URL [seconds]\" per line) for new posts")
+    parser.add_argument("--sync", metavar="FILE",
+                        help="refresh tags and safety of posts already mirrored from the URLs in FILE "
+                             "(\"-\" for stdin) without downloading media")
+    parser.add_argument("--limit", type=int, help="download at most this many files per URL")
+    parser.add_argument("--download-workers", type=int,
+                        help="gallery-dl extractions to run at once in batch and subscription mode "
+                             "(default DOWNLOAD_WORKERS)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on this port (default METRICS_PORT)")
+    parser.add_argument("--metrics-log", metavar="FILE",
+                        help="append a JSON line of metrics to FILE every METRICS_INTERVAL seconds")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write cProfile stats of all pipeline threads to FILE")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global METRICS_PORT, METRICS_LOG, PROFILE_OUTPUT
+    args = parse_args(argv)
+    try:
+        overridden = load_config(args.config)
+    except (OSError, ValueError) as e:
+        print(f"Error reading config {args.config}: {e}")
+        return 2
+    # Command line options win over the config
+    if args.metrics_port is not None:
+        METRICS_PORT = args.metrics_port
+    if args.metrics_log is not None:
+        METRICS_LOG = args.metrics_log
+    if args.profile is not None:
+        PROFILE_OUTPUT = args.profile
+    
+    if args.upload:
+        # Only warm the tag cache if the config or environment asked for it
+        warm_tags = None if "TAG_CACHE_WARM" in overridden else False
+        return 0 if upload_files(args.upload, warm_tags) else 1
+    
     print("Booru to Szurubooru Uploader (Real-time)")
     print("="*50)
     
+    if args.subscribe:
+        subscriptions = read_subscriptions(args.subscribe)
+        if not subscriptions:
+            print("No saved searches to watch")
+            return 1
+        return 0 if run_subscriptions(subscriptions, args.limit, args.download_workers) else 1
+    
+    if args.sync:
+        urls = [split_url_line(line)[0] for line in read_url_list(args.sync)]
+        if not urls:
+            print("No URLs to sync")
+            return 1
+        return 0 if sync_metadata(urls, args.limit) else 1
+    
+    if args.batch:
+        urls = read_url_list(args.batch)
+        if not urls:
+            print("No URLs to download")
+            return 1
+        return 0 if download_batch(urls, args.limit, args.download_workers) else 1
+    
+    if args.url:
+        return 0 if download_from_booru(args.url, args.limit) else 1
+    
+    # Nobody to ask when run from cron or a hook
+    if not sys.stdin.isatty():
+        print("No URL given (pass one, or use --batch, --subscribe, --sync or --upload)")
+        return 2
+    
     # Get URL from user
     url = input("Enter booru URL (post URL, tag search, or user page): ").strip()
     
     # Optional: limit number of downloads
-    limit_input = input("Limit number of downloads? (press Enter for no limit, or enter a number): ").strip()
-    limit = int(limit_input) if limit_input.isdigit() else None
+    limit = args.limit
+    if limit is None:
+        limit_input = input("Limit number of downloads? (press Enter for no limit, or enter a number): ").strip()
+        limit = int(limit_input) if limit_input.isdigit() else None
     
     # Download and upload
-    download_from_booru(url, limit)
+    return 0 if download_from_booru(url, limit) else 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())